@@ -0,0 +1,78 @@
+"""
+Per-file DB overhead of haschanged(): one shared connection versus the
+previous pattern of opening a fresh connection (plus a sqlite_master
+lookup) for every helper call.
+
+Usage: python benchmarks/bench_connection.py [number_of_files]
+"""
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import filechanges
+
+# The files table as the per-call helpers knew it
+LEGACYTABLE = "CREATE TABLE files (id INTEGER PRIMARY KEY, fname VARCHAR(255) NOT NULL, md5 BLOB NOT NULL)"
+DIGEST = bytes.fromhex('d41d8cd98f00b204e9800998ecf8427e')
+
+def legacyconnect(dbfile):
+    """
+    Opens a connection the way every helper used to and checks the table
+    """
+    conn = sqlite3.connect(dbfile, timeout=2)
+    conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?",
+                 ('files',)).fetchall()
+    return conn
+
+
+def legacyhaschanged(dbfile, fname, md5):
+    """
+    Replays the connection pattern of the per-call haschanged()
+    """
+    conn = legacyconnect(dbfile)
+    row = conn.execute("SELECT md5 FROM files WHERE fname = ?", (fname,)).fetchone()
+    conn.commit()
+    conn.close()
+    conn = legacyconnect(dbfile)
+    if row is None:
+        conn.execute("INSERT INTO files (fname, md5) VALUES (?,?)", (fname, md5))
+    else:
+        conn.execute("UPDATE files SET md5 = ? WHERE fname = ?", (md5, fname))
+    conn.commit()
+
+
+def timeit(func, names):
+    start = time.perf_counter()
+    for fname in names:
+        func(fname, DIGEST)
+    return (time.perf_counter() - start) / len(names) * 1e6
+
+
+def main(nfiles):
+    names = [os.path.join('bench', 'dir%03d' % (i % 100), 'file%07d.txt' % i)
+             for i in range(nfiles)]
+    with tempfile.TemporaryDirectory() as tmp:
+        legacydb = os.path.join(tmp, 'legacy.db')
+        conn = sqlite3.connect(legacydb)
+        conn.execute(LEGACYTABLE)
+        conn.execute('CREATE INDEX idxfile ON files (fname)')
+        conn.close()
+        cold = timeit(lambda f, m: legacyhaschanged(legacydb, f, m), names)
+        warm = timeit(lambda f, m: legacyhaschanged(legacydb, f, m), names)
+        print('per-call connections: %8.1f us/file cold, %8.1f us/file warm'
+              % (cold, warm))
+
+        conn = filechanges.connectdb(os.path.join(tmp, 'shared.db'))
+        cold = timeit(lambda f, m: filechanges.haschanged(conn, f, m), names)
+        warm = timeit(lambda f, m: filechanges.haschanged(conn, f, m), names)
+        conn.close()
+        print('shared connection:    %8.1f us/file cold, %8.1f us/file warm'
+              % (cold, warm))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,71 @@
+"""
+Throughput and peak memory of md5short() for file sizes from 1 KB up to
+10 GB. Each size is hashed in its own child process so that its peak RSS
+is measured in isolation.
+
+Usage: python benchmarks/bench_hashing.py [max_size_in_bytes] [directory]
+The default maximum is 1 GB; pass 10737418240 for the full 10 GB run
+(the files are written to the given directory, /tmp by default).
+"""
+import os
+import sys
+import time
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import filechanges
+
+SIZES = [1024, 1024 ** 2, 100 * 1024 ** 2, 1024 ** 3, 10 * 1024 ** 3]
+
+
+def makefile(fname, size):
+    """
+    Writes a file of the given size, made of one block of random bytes
+    repeated over and over: hashing is not faster on repeated content, and
+    the large sizes are written without generating gigabytes of randomness
+    """
+    block = os.urandom(min(size, filechanges.READBLOCKSIZE))
+    with open(fname, 'wb') as open_file:
+        written = 0
+        while written < size:
+            chunk = block[:size - written]
+            open_file.write(chunk)
+            written += len(chunk)
+
+
+def hashone(fname):
+    """
+    Hashes one file and prints size, seconds and peak RSS (KB) as a line
+    """
+    start = time.perf_counter()
+    filechanges.md5short(fname)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(os.path.getsize(fname), elapsed, peak)
+
+
+def main(maxsize, folder):
+    for size in SIZES:
+        if size > maxsize:
+            break
+        fname = os.path.join(folder, 'bench_hashing_%d.bin' % size)
+        makefile(fname, size)
+        try:
+            out = subprocess.check_output(
+                [sys.executable, __file__, '--one', fname], text=True)
+        finally:
+            os.remove(fname)
+        size, elapsed, peak = out.split()
+        mbs = int(size) / 1024 ** 2 / max(float(elapsed), 1e-9)
+        print('%12s bytes: %9.4f s %10.1f MB/s  peak RSS %8d KB'
+              % (size, float(elapsed), mbs, int(peak)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == '--one':
+        hashone(sys.argv[2])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 1024 ** 3,
+             sys.argv[2] if len(sys.argv) > 2 else '/tmp')
@@ -0,0 +1,152 @@
+"""
+Latency of the "what changed below PATH between T1 and T2" queries of the
+history table (see historyrows) over a reproducible synthetic history:
+--rows changes spread evenly over --days days, on files of --folders
+directories three levels deep. Each query runs --repeat times and its
+best time is kept; the results are printed as one JSON document.
+
+Usage: python benchmarks/bench_history.py [options]
+  --rows=N       history rows (default 2000000)
+  --folders=N    directories the changed files are in (default 20000)
+  --days=D       days the history spans, up to now (default 180)
+  --repeat=N     runs of each query (default 5)
+  --seed=S       seed of the history (default 0)
+  --dir=PATH     where to build the DB, kept afterwards (default: a
+                 temporary directory that is removed)
+  --output=FILE  write the JSON there instead of printing it
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import filechanges
+
+# Changes of the synthetic history
+CHANGES = ('CHANGED', 'IS_SETUP', 'DELETED', 'RENAMED')
+
+
+def folderpaths(count):
+    """
+    Get the paths of the synthetic directories, 100 per top directory and
+    10 per middle one
+    """
+    return ['/data/p%04d/s%02d/d%d/' % (i // 100, i // 10 % 10, i % 10)
+            for i in range(count)]
+
+
+def makehistory(conn, params):
+    """
+    Appends the synthetic history to the DB, in the order it is found
+    """
+    rng = random.Random(params['seed'])
+    folders = folderpaths(params['folders'])
+    span = params['days'] * 86400
+    start = time.time() - span
+    step = span / params['rows']
+    conn.execute('BEGIN')
+    rows = []
+    for n in range(params['rows']):
+        rows.append((start + n * step,
+                     rng.choice(folders) + 'f%d' % rng.randrange(50),
+                     rng.choice(CHANGES), ''))
+        if len(rows) == 50000:
+            filechanges.writehistory(conn, rows)
+            rows = []
+    filechanges.writehistory(conn, rows)
+    conn.commit()
+
+
+def queries(now):
+    """
+    Get the (name, path, since, until) queries measured
+    """
+    hour, day = 3600, 86400
+    return [
+        ('tree_last_hour', '/data', now - hour, now),
+        ('tree_last_day', '/data', now - day, now),
+        ('top_dir_last_week', '/data/p0042', now - 7 * day, now),
+        ('middle_dir_all', '/data/p0042/s03', None, None),
+        ('leaf_dir_10_days', '/data/p0042/s03/d4', now - 30 * day,
+         now - 20 * day),
+        ('one_file_all', '/data/p0042/s03/d4/f7', None, None),
+    ]
+
+
+def timequery(conn, path, since, until, repeat):
+    """
+    Get the best time of a query in seconds and the rows it returned
+    """
+    best, count = None, 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = sum(1 for _ in filechanges.historyrows(conn, path, since,
+                                                        until))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, count
+
+
+def gitcommit():
+    """
+    Get the commit the benchmark runs on, None outside of a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    params = {
+        'rows': int(filechanges.getarg(args, '--rows', 2000000)),
+        'folders': int(filechanges.getarg(args, '--folders', 20000)),
+        'days': float(filechanges.getarg(args, '--days', 180)),
+        'seed': int(filechanges.getarg(args, '--seed', 0)),
+    }
+    repeat = int(filechanges.getarg(args, '--repeat', 5))
+    keep = filechanges.getarg(args, '--dir')
+    workdir = os.path.abspath(keep) if keep else tempfile.mkdtemp()
+    try:
+        conn = filechanges.connectdb(os.path.join(workdir, 'history.db'))
+        start = time.perf_counter()
+        makehistory(conn, params)
+        built = time.perf_counter() - start
+        now = time.time()
+        results = {}
+        for name, path, since, until in queries(now):
+            seconds, count = timequery(conn, path, since, until, repeat)
+            results[name] = {'ms': seconds * 1000, 'rows': count}
+        conn.close()
+        result = {
+            'benchmark': 'history',
+            'commit': gitcommit(),
+            'python': sys.version.split()[0],
+            'sqlite': sqlite3.sqlite_version,
+            'params': params,
+            'build_seconds': built,
+            'db_bytes': os.path.getsize(os.path.join(workdir, 'history.db')),
+            'queries': results,
+        }
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    output = filechanges.getarg(args, '--output')
+    if output:
+        with open(output, 'w') as open_file:
+            json.dump(result, open_file, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
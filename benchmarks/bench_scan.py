@@ -0,0 +1,295 @@
+"""
+Throughput of runfilechanges() on a reproducible synthetic tree: a cold
+pass on an empty DB, a warm pass with nothing changed and a pass after a
+share of the files was modified, added, deleted or renamed. Each pass
+runs in its own child process so that its peak RSS is measured in
+isolation, and the results are printed as one JSON document that can be
+kept and compared across commits.
+
+Usage: python benchmarks/bench_scan.py [options]
+  --files=N      files in the tree (default 10000)
+  --size=B       mean file size in bytes (default 16384)
+  --sigma=S      sigma of the lognormal file sizes, 0 for fixed sizes (1.0)
+  --maxsize=B    largest file size in bytes (default 64 MiB)
+  --depth=D      directory levels below the root (default 3)
+  --fanout=F     subdirectories per directory (default 8)
+  --change=P     percent of the files touched before the last pass (10)
+  --seed=S       seed of the tree and of the changes (default 0)
+  --dir=PATH     where to build the tree, kept afterwards (default: a
+                 temporary directory that is removed)
+  --output=FILE  write the JSON there instead of printing it
+The scan options --batch=N, --workers=N, --processes, --snapshot and
+--shards=N are passed on to the passes.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import sqlite3
+import resource
+import tempfile
+import subprocess
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import filechanges
+
+# Scan options handed over to the passes
+SCANFLAGS = ('--batch=', '--workers=', '--processes', '--snapshot',
+             '--shards=')
+# Share of the touched files that are modified, added, deleted and renamed
+MUTATIONS = (('modified', 0.5), ('added', 0.2), ('deleted', 0.15),
+             ('renamed', 0.15))
+# Random bytes the file contents are cut from
+BLOCKSIZE = 1024 * 1024
+
+
+def makedirs(root, depth, fanout):
+    """
+    Creates the directories of the tree and returns their paths
+    """
+    dirs = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [os.path.join(parent, 'd%02d' % i)
+                 for parent in level for i in range(fanout)]
+        dirs.extend(level)
+    for subdir in dirs:
+        os.makedirs(subdir, exist_ok=True)
+    return dirs
+
+
+def filesize(rng, params):
+    """
+    Draws a file size from a lognormal distribution of the mean params['size']
+    """
+    mean, sigma = params['size'], params['sigma']
+    if sigma <= 0:
+        return mean
+    mu = math.log(max(mean, 1)) - sigma * sigma / 2
+    return min(int(rng.lognormvariate(mu, sigma)), params['maxsize'])
+
+
+def writefile(fname, size, block, seq):
+    """
+    Writes a file of the given size, unique through its sequence number
+    """
+    header = b'%d\n' % seq
+    with open(fname, 'wb') as open_file:
+        open_file.write(header[:size])
+        written = len(header[:size])
+        while written < size:
+            chunk = block[:size - written]
+            open_file.write(chunk)
+            written += len(chunk)
+    return size
+
+
+def maketree(root, params):
+    """
+    Builds the synthetic tree and returns the list of its files
+    The same parameters and seed always give the same tree.
+    """
+    rng = random.Random(params['seed'])
+    block = rng.randbytes(BLOCKSIZE)
+    dirs = makedirs(root, params['depth'], params['fanout'])
+    files = []
+    for seq in range(params['files']):
+        fname = os.path.join(rng.choice(dirs), 'f%07d.dat' % seq)
+        writefile(fname, filesize(rng, params), block, seq)
+        files.append(fname)
+    return files
+
+
+def mutate(root, files, params):
+    """
+    Touches params['change'] percent of the files, split as MUTATIONS
+    Returns how many files got each change.
+    """
+    rng = random.Random(params['seed'] + 1)
+    block = rng.randbytes(BLOCKSIZE)
+    dirs = makedirs(root, params['depth'], params['fanout'])
+    touched = rng.sample(files, int(len(files) * params['change'] / 100))
+    counts = {}
+    start = 0
+    seq = len(files)
+    for change, share in MUTATIONS:
+        count = int(len(touched) * share)
+        counts[change] = count
+        for fname in touched[start:start + count]:
+            if change == 'modified':
+                with open(fname, 'ab') as open_file:
+                    open_file.write(b'%d\n' % seq)
+            elif change == 'added':
+                newname = os.path.join(rng.choice(dirs), 'f%07d.dat' % seq)
+                writefile(newname, filesize(rng, params), block, seq)
+            elif change == 'deleted':
+                os.remove(fname)
+            else:
+                os.rename(fname, os.path.join(rng.choice(dirs),
+                                              'f%07d.dat' % seq))
+            seq += 1
+        start += count
+    return counts
+
+
+class CountingReport:
+    """
+    Report that only counts the changed files by kind of change
+    """
+
+    def __init__(self):
+        self.changes = {}
+
+    def addrow(self, fn, ffn, fld, d, t, change, detail=''):
+        self.changes[change] = self.changes.get(change, 0) + 1
+
+    def rotate(self):
+        return None
+
+    def flush(self):
+        return None
+
+    def rollback(self):
+        return None
+
+    def close(self):
+        return None
+
+
+def runpass(workdir, args):
+    """
+    Runs one scan pass in workdir and prints its measures as a JSON line
+    """
+    os.chdir(workdir)
+    settings = filechanges.ScanSettings(
+        int(filechanges.getarg(args, '--batch', filechanges.BATCHSIZE)),
+        pool=filechanges.makepool(int(filechanges.getarg(args, '--workers', 1)),
+                                  '--processes' in args),
+        snapshot='--snapshot' in args)
+    shards = int(filechanges.getarg(args, '--shards', 1))
+    if shards > 1:
+        settings.shardpool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=shards)
+    dbops = [0]
+    conn = filechanges.connectdb()
+    conn.set_trace_callback(lambda statement: dbops.__setitem__(0, dbops[0] + 1))
+    report = CountingReport()
+    # Silence the per-file lines of the scan
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.perf_counter()
+        filechanges.runfilechanges(conn, report, settings)
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        conn.close()
+        if settings.pool is not None:
+            settings.pool.shutdown()
+        if settings.shardpool is not None:
+            settings.shardpool.shutdown()
+    # Counted by the scan itself, so the shard workers are included
+    hashed = {'files': settings.metrics.counts['hashed'],
+              'bytes': settings.metrics.counts['hashed_bytes']}
+    print(json.dumps({
+        'seconds': elapsed,
+        'hashed_files': hashed['files'],
+        'hashed_bytes': hashed['bytes'],
+        'hashed_mb_per_s': hashed['bytes'] / 1024 ** 2 / max(elapsed, 1e-9),
+        'db_statements': dbops[0],
+        'changes': report.changes,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+
+def measure(workdir, nfiles, flags):
+    """
+    Runs a pass in a child process and returns its measures
+    """
+    out = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--one', workdir] + flags,
+        text=True)
+    result = json.loads(out.splitlines()[-1])
+    result['files_per_s'] = nfiles / max(result['seconds'], 1e-9)
+    return result
+
+
+def gitcommit():
+    """
+    Get the commit the benchmark runs on, None outside of a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    params = {
+        'files': int(filechanges.getarg(args, '--files', 10000)),
+        'size': int(filechanges.getarg(args, '--size', 16384)),
+        'sigma': float(filechanges.getarg(args, '--sigma', 1.0)),
+        'maxsize': int(filechanges.getarg(args, '--maxsize', 64 * 1024 ** 2)),
+        'depth': int(filechanges.getarg(args, '--depth', 3)),
+        'fanout': int(filechanges.getarg(args, '--fanout', 8)),
+        'change': float(filechanges.getarg(args, '--change', 10)),
+        'seed': int(filechanges.getarg(args, '--seed', 0)),
+    }
+    flags = [arg for arg in args if arg.startswith(SCANFLAGS)]
+    keep = filechanges.getarg(args, '--dir')
+    workdir = os.path.abspath(keep) if keep else tempfile.mkdtemp()
+    root = os.path.join(workdir, 'tree')
+    try:
+        start = time.perf_counter()
+        files = maketree(root, params)
+        treebytes = sum(os.path.getsize(fname) for fname in files)
+        built = time.perf_counter() - start
+        with open(os.path.join(workdir, 'filechanges.ini'), 'w') as config:
+            config.write(root + '\n')
+        dbfile = os.path.join(workdir, 'filechanges.db')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(dbfile + suffix):
+                os.remove(dbfile + suffix)
+        phases = {}
+        phases['cold'] = measure(workdir, len(files), flags)
+        phases['warm'] = measure(workdir, len(files), flags)
+        mutations = mutate(root, files, params)
+        phases['mutated'] = measure(workdir, len(files), flags)
+        phases['mutated']['mutations'] = mutations
+        result = {
+            'benchmark': 'scan',
+            'commit': gitcommit(),
+            'python': sys.version.split()[0],
+            'sqlite': sqlite3.sqlite_version,
+            'cpus': os.cpu_count(),
+            'params': params,
+            'flags': flags,
+            'tree': {'files': len(files), 'bytes': treebytes,
+                     'build_seconds': built},
+            'db_bytes': os.path.getsize(dbfile),
+            'phases': phases,
+        }
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    output = filechanges.getarg(args, '--output')
+    if output:
+        with open(output, 'w') as open_file:
+            json.dump(result, open_file, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == '--one':
+        runpass(sys.argv[2], sys.argv[3:])
+    else:
+        main(sys.argv[1:])
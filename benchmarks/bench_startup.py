@@ -0,0 +1,146 @@
+"""
+Cold start of filechanges.py, as paid by every short run started from
+cron: the import time of the module, measured by the interpreter itself
+with -X importtime, the modules it pulls in that a bare interpreter does
+not load, and the wall time of a whole run that does not scan (--rollup),
+started as a script and with python -m. A script is compiled again on
+every run, while python -m filechanges loads the cached bytecode.
+Every measure runs in a fresh interpreter, after a first run that writes
+the bytecode cache. The results are printed as one JSON document.
+
+The exit status is 1 when the median import time is over the budget or
+when one of the LAZY modules is imported by filechanges at load time;
+tests/test_startup.py runs the same checks with the test suite.
+
+Usage: python benchmarks/bench_startup.py [options]
+  --runs=N        fresh interpreters per measure (default 20)
+  --budget-ms=MS  largest median import time of filechanges (default 25)
+  --output=FILE   write the JSON there instead of printing it
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import filechanges
+
+# Where filechanges.py lives
+PACKAGEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules only some runs need, that must not be imported at load time
+LAZY = ('re', 'csv', 'json', 'socket', 'shutil', 'tempfile', 'logging',
+        'concurrent.futures', 'fswatch', 'ctypes', 'openpyxl')
+# Lists the modules loaded by an interpreter, after running its argument
+LOADED = 'import sys; exec(sys.argv[1]); print(" ".join(sorted(sys.modules)))'
+
+
+def pythonenv():
+    """
+    Get the environment of the measured interpreters: bytecode is cached,
+    as it is on a host where filechanges runs from cron
+    """
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = PACKAGEDIR
+    return env
+
+
+def importtime(env):
+    """
+    Get the cumulative import time of filechanges in microseconds
+    """
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                          'import filechanges'], env=env, cwd=PACKAGEDIR,
+                         stderr=subprocess.PIPE, text=True, check=True).stderr
+    for line in out.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'filechanges':
+            return int(fields[1])
+    raise RuntimeError('no import time reported for filechanges')
+
+
+def loaded(env, statement):
+    """
+    Get the set of modules an interpreter has loaded after a statement
+    """
+    out = subprocess.check_output([sys.executable, '-c', LOADED, statement],
+                                  env=env, cwd=PACKAGEDIR, text=True)
+    return set(out.split())
+
+
+def walltime(command, env, cwd):
+    """
+    Get the wall time of a command in seconds
+    """
+    start = time.perf_counter()
+    subprocess.run(command, env=env, cwd=cwd, stdout=subprocess.DEVNULL,
+                   check=True)
+    return time.perf_counter() - start
+
+
+def gitcommit():
+    """
+    Get the commit the benchmark runs on, None outside of a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL,
+            cwd=PACKAGEDIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    runs = int(filechanges.getarg(args, '--runs', 20))
+    budget = float(filechanges.getarg(args, '--budget-ms', 25))
+    env = pythonenv()
+    # The run that writes the bytecode cache is not measured
+    importtime(env)
+    imports = [importtime(env) / 1000 for _ in range(runs)]
+    bare = loaded(env, 'pass')
+    eager = sorted(name for name in LAZY if name in
+                   loaded(env, 'import filechanges') - bare)
+    workdir = tempfile.mkdtemp()
+    try:
+        # A run that only reads the DB: interpreter, import, connection
+        script = os.path.join(PACKAGEDIR, 'filechanges.py')
+        interpreter = [walltime([sys.executable, '-c', 'pass'], env, workdir)
+                       for _ in range(runs)]
+        rollup = '--rollup=' + workdir
+        scriptruns = [walltime([sys.executable, script, rollup], env, workdir)
+                      for _ in range(runs)]
+        moduleruns = [walltime([sys.executable, '-m', 'filechanges', rollup],
+                               env, workdir) for _ in range(runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    median = statistics.median(imports)
+    result = {
+        'benchmark': 'startup',
+        'commit': gitcommit(),
+        'python': sys.version.split()[0],
+        'runs': runs,
+        'import_ms': {'median': median, 'min': min(imports),
+                      'max': max(imports)},
+        'interpreter_ms': statistics.median(interpreter) * 1000,
+        'script_run_ms': statistics.median(scriptruns) * 1000,
+        'module_run_ms': statistics.median(moduleruns) * 1000,
+        'eager_imports': eager,
+        'budget_ms': budget,
+        'ok': median <= budget and not eager,
+    }
+    output = filechanges.getarg(args, '--output')
+    if output:
+        with open(output, 'w') as open_file:
+            json.dump(result, open_file, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+    return 0 if result['ok'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,83 @@
+"""
+Time and peak RSS of writing an Excel report of N changed files (1M by
+default) with XlsxSink, and optionally with the previous approach of
+an in-memory workbook whose last row is looked up for every append.
+
+Usage: python benchmarks/bench_xlsreport.py [rows] [--legacy=ROWS]
+The legacy run is quadratic, keep its row count small (e.g. 20000).
+"""
+import os
+import sys
+import time
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import openpyxl
+import filechanges
+
+
+def fillrows(addrow, nrows):
+    for i in range(nrows):
+        fname = 'file%07d.txt' % i
+        folder = '/data/dir%04d' % (i % 1000)
+        addrow(fname, folder + '/' + fname, folder, '18-Oct-2026', '12_00_00',
+               'CHANGED')
+
+
+def streamed(nrows):
+    report = filechanges.XlsxSink()
+    fillrows(report.addrow, nrows)
+    report.close()
+
+
+def legacy(nrows):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+
+    def addrow(fn, ffn, fld, d, t, change=None):
+        row = 1
+        for cell in ws["A"]:
+            if cell.value is None:
+                break
+            row += 1
+        for col, value in enumerate((fn, ffn, fld, d, t), 1):
+            ws.cell(row=row, column=col, value=value)
+
+    addrow(*filechanges.XlsxSink.HEADER[:5])
+    fillrows(addrow, nrows)
+    wb.save('REPORT_legacy.xlsx')
+
+
+def runone(mode, nrows):
+    """
+    Writes one report in a temporary directory, prints seconds and peak RSS
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        start = time.perf_counter()
+        (streamed if mode == 'streamed' else legacy)(nrows)
+        elapsed = time.perf_counter() - start
+    print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main(args):
+    runs = [('streamed', int(args[0]) if args and args[0].isdigit() else 10 ** 6)]
+    legacyrows = filechanges.getarg(args, '--legacy')
+    if legacyrows:
+        runs.append(('legacy', int(legacyrows)))
+    for mode, nrows in runs:
+        out = subprocess.check_output(
+            [sys.executable, __file__, '--one', mode, str(nrows)], text=True)
+        elapsed, peak = out.split()
+        print('%-8s %9d rows: %8.2f s %10.0f rows/s  peak RSS %8d KB'
+              % (mode, nrows, float(elapsed), nrows / float(elapsed), int(peak)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3 and sys.argv[1] == '--one':
+        runone(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(sys.argv[1:])
@@ -1,16 +1,82 @@
 import time
 import os
 import sys
+import stat
+import mmap
+import threading
+import collections
+import itertools
+import heapq
 import sqlite3
 import hashlib
-import openpyxl
-import socket
+import struct
+# re, csv, json, socket, shutil, tempfile, concurrent.futures, fswatch and
+# openpyxl are imported by the code that needs them, so that a short scan
+# starts fast (see benchmarks/bench_startup.py)
 
-from openpyxl import Workbook
-from openpyxl.styles import Font
 from sqlite3 import Error
 from datetime import datetime
 
+# Number of prepared statements each connection keeps cached
+STMTCACHESIZE = 64
+# Version of the DB schema, kept in PRAGMA user_version
+SCHEMAVERSION = 7
+# Page cache of each connection, in KiB (PRAGMA cache_size)
+CACHESIZE = 64 * 1024
+# Number of rows written per executemany() during a scan pass
+BATCHSIZE = 1000
+# Size of the blocks files are read and hashed in
+READBLOCKSIZE = 1024 * 1024
+# Files of at least this size are hashed through mmap, one window of
+# this size at a time (a multiple of mmap.ALLOCATIONGRANULARITY)
+MMAPTHRESHOLD = 64 * 1024 * 1024
+# Per-thread read buffers, see getreadbuffer()
+READBUFFERS = threading.local()
+# Files queued or being hashed at once in pipeline mode (--workers=N)
+PIPELINEDEPTH = 256
+# How scantree() treats symbolic links, see the symlinks folder option
+SYMLINKPOLICIES = ('skip', 'files', 'follow')
+DEFAULTSYMLINKS = 'files'
+# How a configured folder is split for --shards, see the shard folder option
+SHARDMODES = ('folder', 'subdirs')
+# A regular file found by scantree()
+FileRecord = collections.namedtuple('FileRecord', 'name path subdir stat')
+# What hashjob() got out of a file
+Hashed = collections.namedtuple('Hashed', 'digests sample blocks tailok')
+# Write buffer of the CSV and JSON Lines report sinks
+SINKBUFFERSIZE = 1024 * 1024
+# Packed size, mtime_ns, inode, dev, algorithm and digest size of a
+# Snapshot row, followed by the digest and the sample
+SNAPSHOTROW = struct.Struct('<qqqqBB')
+# Seconds between the passes of --loop, and between the full scans of
+# --watch when inotify can't be used (--interval)
+WATCHINTERVAL = 60
+# Seconds between the checkpoints of a scan pass (--checkpoint)
+CHECKPOINTSECS = 60
+# File stat columns compared before a file gets hashed
+STATCOLUMNS = ('size', 'mtime_ns', 'inode', 'dev')
+# Hash algorithms a folder can be tracked with, see gethasher()
+HASHERS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+    'blake2s': hashlib.blake2s,
+}
+# Blocks read for the sampled fingerprint of a large file, see samplefile()
+SAMPLEBLOCKSIZE = 64 * 1024
+DEFAULTSAMPLEBLOCKS = 16
+# Digest size of the directory rollups of the dirs table, see entryhash()
+ROLLUPSIZE = 16
+# Changed byte ranges listed at most in the Detail of a report row
+MAXRANGES = 16
+# Bytes hashed at the start of the files of a size bucket before they are
+# hashed in full, see bucketgroups()
+PREFIXSIZE = 64 * 1024
+# Hash algorithm of folders that do not set one, and of rows stored
+# before the algo column existed
+DEFAULTALGO = 'md5'
+
 
 def getbasefile():
     """
@@ -19,14 +85,20 @@ def getbasefile():
     return os.path.splitext(os.path.basename(__file__))[0]
 
 
-def connectdb():
+def connectdb(dbfile=None):
     """
     Connects to the SQLite DB
+    One connection is meant to live for a whole scan: it is passed to
+    every DB helper below, keeps its prepared statements cached and
+    checks the schema only once, when it is opened.
     """
     try:
-        dbfile = getbasefile() + '.db'
-        conn = sqlite3.connect(dbfile, timeout=2)
+        dbfile = dbfile or getbasefile() + '.db'
+        conn = sqlite3.connect(dbfile, timeout=2,
+                               cached_statements=STMTCACHESIZE)
         #print("Connection is established: Database is created on disk")
+        tunedb(conn)
+        setupdb(conn)
         return conn
     except Error as e:
         print('Connection went wrong:', e)
@@ -46,358 +118,3404 @@ def corecursor(conn, query, args=None):
     return cursor
 
 
-def tableexists(table):
+def tableexists(conn, table):
     """
     Checks if a SQLite DB Table exists
     """
     result = False
+    query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?"
+    cursor = corecursor(conn, query, (table,))
+    if cursor is not None:
+        result = cursor.fetchone() is not None
+        cursor.close()
+    #print('Table exist:', result)
+    return result
+
+
+def tunedb(conn):
+    """
+    Sets the journaling and caching pragmas of a connection
+    With WAL journaling, readers - e.g. report queries from another
+    connection - keep reading the last committed pass while a scan
+    writes the next one, and synchronous=NORMAL only syncs the WAL at
+    checkpoints, which stays safe against corruption in that mode.
+    """
+    result = False
+    pragmas = ['journal_mode = WAL', 'synchronous = NORMAL',
+               'cache_size = -%d' % CACHESIZE]
     try:
-        conn = connectdb()
-        if conn != None:
-            query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?"
-            args = (table,)
-            cursor = corecursor(conn, query, args)
-            rows = cursor.fetchall()
-            numrows = len(list(rows))
-            if numrows > 0:
-                result = True
-        #print('Table exist:', result)
+        for pragma in pragmas:
+            conn.execute('PRAGMA ' + pragma)
+        result = True
     except Error as e:
-        print(e)
-    finally:
-        cursor.close()
-        if conn != None:
-            conn.commit()
-            conn.close()
-            #print("Closed connection to the database successfully")
+        print('Tune the SQLite DB went wrong: ', e)
     return result
 
 
-def createhashtable():
+def schemaversion(conn):
+    """
+    Get the schema version of the DB, 0 for a new DB
+    DBs made before the schema was versioned are version 1.
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version == 0 and tableexists(conn, 'files'):
+        version = 1
+    return version
+
+
+def createhashtable(conn):
     """
     Creates a SQLite DB Table
     Function that can create a file-level tracking database table
     on a local SQLite instance.
+    Every file is stored as the id of its directory in the folders table
+    (the path of the directory, ending with a path separator) and its
+    name, with the raw bytes of its digest and, for large files, of its
+    sampled fingerprint (see samplefile). The block digests of the files
+    hashed as a Merkle tree (see blockalgo) are kept in blocks, and the
+    rollup of every directory above a file in dirs (see rolldirs). The
+    checkpoint of an interrupted scan pass is kept in checkpoints and
+    checkpointmoves (see savecheckpoint), and every change ever found in
+    history (see HistoryLog).
     """
     result = False
-    query = "CREATE TABLE files (id INTEGER PRIMARY KEY, fname VARCHAR(255) NOT NULL, md5 BLOB NOT NULL )"
+    queries = [
+        "CREATE TABLE IF NOT EXISTS folders (id INTEGER PRIMARY KEY, path TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, folder INTEGER NOT NULL REFERENCES folders (id), name TEXT NOT NULL, digest BLOB NOT NULL, size INTEGER, mtime_ns INTEGER, inode INTEGER, dev INTEGER, algo TEXT, sample BLOB )",
+        "CREATE TABLE IF NOT EXISTS blocks (file INTEGER NOT NULL REFERENCES files (id), idx INTEGER NOT NULL, digest BLOB NOT NULL, PRIMARY KEY (file, idx)) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, rollup BLOB NOT NULL, count INTEGER NOT NULL) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS checkpoints (folder TEXT PRIMARY KEY, lastdir TEXT, done INTEGER NOT NULL DEFAULT 0, updated REAL)",
+        "CREATE TABLE IF NOT EXISTS checkpointmoves (folder TEXT NOT NULL, kind TEXT NOT NULL, fname TEXT NOT NULL, md5 BLOB, size INTEGER, algo TEXT)",
+        "CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, stamp REAL NOT NULL, folder INTEGER NOT NULL REFERENCES folders (id), name TEXT NOT NULL, change TEXT NOT NULL, detail TEXT)",
+    ]
     try:
-        conn = connectdb()
-        if conn != None:
-            if tableexists('files') == False:
-                try:
-                    cursor = corecursor(conn, query)
-                    cursor.close()
-                    result = True
-                    #print('Created a SQLite DB Table!')
-                except Error as e:
-                    print('Create a SQLite DB Table went wrong: ', e)
+        for query in queries:
+            conn.execute(query)
+        result = True
+        #print('Created a SQLite DB Table!')
     except Error as e:
-        print(e)
-    finally:
-        if conn != None:
-            conn.commit()
-            conn.close()
-            #print("Closed connection to the database successfully")
+        print('Create a SQLite DB Table went wrong: ', e)
+    return result
+
+
+def addhashtablecols(conn):
+    """
+    Adds the file stat and hash algorithm columns to a version 1 files
+    table created by older versions
+    """
+    result = False
+    newcols = [(col, 'INTEGER') for col in STATCOLUMNS] + [('algo', 'TEXT')]
+    try:
+        cols = [row[1] for row in conn.execute('PRAGMA table_info(files)')]
+        for col, coltype in newcols:
+            if col not in cols:
+                conn.execute('ALTER TABLE files ADD COLUMN %s %s' % (col, coltype))
+        result = True
+    except Error as e:
+        print('Add the SQLite DB Table columns went wrong: ', e)
     return result
 
 
-def createhashtableidx():
+def createhashtableidx(conn):
     """
     Creates a SQLite DB Table Index
     Function that create a file-level tracking table index
     on a local SQLite instance
+    The files and folders indexes are UNIQUE: batched upserts rely on
+    ON CONFLICT(folder, name), and the folders of a tree are read in path
+    order through idxfolderpath (see dbrows). The subdirectories of a
+    directory are found through idxdirparent (see childdirs). The history
+    of a time range is read through idxhistorystamp, and that of a tree
+    through idxfolderpath and idxhistoryfolder (see historyrows).
     """
     result = False
-    table = 'files'
-    query = 'CREATE INDEX idxfile ON files (fname)'  # Finish this query ...
+    queries = [
+        'CREATE UNIQUE INDEX IF NOT EXISTS idxfolderpath ON folders (path)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idxfname ON files (folder, name)',
+        'CREATE INDEX IF NOT EXISTS idxdirparent ON dirs (parent)',
+        'CREATE INDEX IF NOT EXISTS idxhistorystamp ON history (stamp)',
+        'CREATE INDEX IF NOT EXISTS idxhistoryfolder ON history (folder, stamp)',
+    ]
     try:
-        conn = connectdb()
-        if conn != None:
-            if tableexists(table) == False:
-                createhashtable()
-            else:
-                try:
-                    cursor = corecursor(conn, query)
-                    # cursor.close()
-                    result = True
-                    #print('Create a SQLite DB Table INDEX!')
-                except Error as e:
-                    print('Create a SQLite DB Table INDEX went wrong: ', e)
+        for query in queries:
+            conn.execute(query)
+        result = True
+        #print('Create a SQLite DB Table INDEX!')
     except Error as e:
-        print(e)
-    finally:
-        if conn != None:
-            conn.commit()
-            conn.close()
-            #print("Closed connection to the database successfully")
+        print('Create a SQLite DB Table INDEX went wrong: ', e)
+    return result
+
+
+def rawdigest(md5):
+    """
+    Get the raw bytes of a digest stored by version 1 as hex text
+    """
+    if isinstance(md5, str):
+        try:
+            digest = bytes.fromhex(md5)
+            if digest.hex() == md5:
+                return digest
+        except ValueError:
+            pass
+        return md5.encode('utf-8', 'surrogatepass')
+    return bytes(md5)
+
+
+def migratev1(conn):
+    """
+    Moves a version 1 DB over to version 2
+    Version 1 kept the full path of every file in files.fname and its
+    digest as hex text. The rows are copied BATCHSIZE at a time into the
+    version 2 tables in one transaction, so an interrupted migration
+    leaves the DB as it was. Duplicate fname rows keep the newest one.
+    """
+    result = False
+    try:
+        conn.execute('BEGIN')
+        if not addhashtablecols(conn):
+            raise Error('the version 1 files table can not be read')
+        conn.execute('DROP INDEX IF EXISTS idxfname')
+        conn.execute('DROP INDEX IF EXISTS idxfile')
+        conn.execute('ALTER TABLE files RENAME TO files_v1')
+        if not (createhashtable(conn) and createhashtableidx(conn)):
+            raise Error('the version 2 tables can not be created')
+        cursor = conn.execute("SELECT fname, md5, size, mtime_ns, inode, dev, algo FROM files_v1 ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(BATCHSIZE)
+            if not rows:
+                break
+            writerows(conn, [(row[0], rawdigest(row[1])) + tuple(row[2:]) +
+                             (None,) for row in rows])
+        conn.execute('DROP TABLE files_v1')
+        conn.execute('PRAGMA user_version = 2')
+        conn.commit()
+        result = True
+    except Error as e:
+        conn.rollback()
+        print('Migrate the SQLite DB to version 2 went wrong: ', e)
+    return result
+
+
+def migratev2(conn):
+    """
+    Moves a version 2 DB over to version 3, which keeps the sampled
+    fingerprint of large files in files.sample
+    """
+    result = False
+    try:
+        cols = [row[1] for row in conn.execute('PRAGMA table_info(files)')]
+        if 'sample' not in cols:
+            conn.execute('ALTER TABLE files ADD COLUMN sample BLOB')
+        conn.execute('PRAGMA user_version = 3')
+        conn.commit()
+        result = True
+    except Error as e:
+        conn.rollback()
+        print('Migrate the SQLite DB to version 3 went wrong: ', e)
+    return result
+
+
+def migratev3(conn):
+    """
+    Moves a version 3 DB over to version 4, which keeps the block digests
+    of the files hashed as a Merkle tree in the blocks table
+    """
+    result = False
+    try:
+        if not createhashtable(conn):
+            raise Error('the blocks table can not be created')
+        conn.execute('PRAGMA user_version = 4')
+        conn.commit()
+        result = True
+    except Error as e:
+        conn.rollback()
+        print('Migrate the SQLite DB to version 4 went wrong: ', e)
+    return result
+
+
+def migratev4(conn):
+    """
+    Moves a version 4 DB over to version 5, which keeps the rollup of every
+    directory in the dirs table
+    The rollups are rebuilt from the files rows, BATCHSIZE at a time, in
+    one transaction.
+    """
+    result = False
+    try:
+        conn.execute('BEGIN')
+        if not (createhashtable(conn) and createhashtableidx(conn)):
+            raise Error('the dirs table can not be created')
+        # Earlier migrations may have written rows through writerows()
+        conn.execute('DELETE FROM dirs')
+        deltas = {}
+        cursor = conn.execute("SELECT d.path, f.name, f.digest FROM files f JOIN folders d ON d.id = f.folder")
+        for rows in iter(lambda: cursor.fetchmany(BATCHSIZE), []):
+            filedeltas(((path, name, digest, 1) for path, name, digest in rows),
+                       deltas)
+        rolldirs(conn, deltas)
+        conn.execute('PRAGMA user_version = 5')
+        conn.commit()
+        result = True
+    except Error as e:
+        conn.rollback()
+        print('Migrate the SQLite DB to version 5 went wrong: ', e)
+    return result
+
+
+def migratev5(conn):
+    """
+    Moves a version 5 DB over to version 6, which keeps the checkpoint of
+    an interrupted scan pass in the checkpoints and checkpointmoves tables
+    """
+    result = False
+    try:
+        if not createhashtable(conn):
+            raise Error('the checkpoints tables can not be created')
+        conn.execute('PRAGMA user_version = 6')
+        conn.commit()
+        result = True
+    except Error as e:
+        conn.rollback()
+        print('Migrate the SQLite DB to version 6 went wrong: ', e)
+    return result
+
+
+def migratev6(conn):
+    """
+    Moves a version 6 DB over to version 7, which keeps every change found
+    in the history table
+    The rows of the changes table of the sqlite report (see SqliteSink),
+    if any, are copied to history, in one transaction.
+    """
+    result = False
+    try:
+        conn.execute('BEGIN')
+        if not (createhashtable(conn) and createhashtableidx(conn)):
+            raise Error('the history table can not be created')
+        if tableexists(conn, 'changes'):
+            cursor = conn.execute("SELECT fullname, date, time, change, detail FROM changes ORDER BY id")
+            for rows in iter(lambda: cursor.fetchmany(BATCHSIZE), []):
+                writehistory(conn, [(reportstamp(d, t), fullname, change, detail)
+                                    for fullname, d, t, change, detail in rows
+                                    if reportstamp(d, t) is not None])
+        conn.execute('PRAGMA user_version = 7')
+        conn.commit()
+        result = True
+    except Error as e:
+        conn.rollback()
+        print('Migrate the SQLite DB to version 7 went wrong: ', e)
+    return result
+
+
+# Migration of the DB from each schema version to the next one
+MIGRATIONS = {
+    1: migratev1,
+    2: migratev2,
+    3: migratev3,
+    4: migratev4,
+    5: migratev5,
+    6: migratev6,
+}
+
+
+def createmovetables(conn, temp=True):
+    """
+    Creates the temporary tables the gone and new files of a folder are
+    collected in, until they are paired as renames (see pairmoves)
+    They live in the temp schema of the connection, so they are never
+    written to the DB file; with temp=False they are created in the
+    main schema instead, as in the spool of a shard (see openspool).
+    """
+    result = False
+    kind, schema = ('TEMP ', 'temp.') if temp else ('', '')
+    queries = [
+        "CREATE %sTABLE IF NOT EXISTS gonefiles (fname TEXT PRIMARY KEY, md5 BLOB, size INTEGER, algo TEXT, paired INTEGER NOT NULL DEFAULT 0)" % kind,
+        "CREATE INDEX IF NOT EXISTS %sidxgonemd5 ON gonefiles (md5)" % schema,
+        "CREATE %sTABLE IF NOT EXISTS newfiles (fname TEXT NOT NULL, md5 BLOB, size INTEGER, algo TEXT)" % kind,
+    ]
+    try:
+        for query in queries:
+            conn.execute(query)
+        result = True
+    except Error as e:
+        print('Create the SQLite temporary tables went wrong: ', e)
+    return result
+
+
+def setupdb(conn):
+    """
+    Setup's the Hash Table and its index, once per connection
+    A new DB gets the SCHEMAVERSION tables right away, older ones are
+    moved over by the MIGRATIONS, one version at a time.
+    """
+    version = schemaversion(conn)
+    if version == 0:
+        result = createhashtable(conn) and createhashtableidx(conn)
+        conn.execute('PRAGMA user_version = %d' % SCHEMAVERSION)
+    elif version > SCHEMAVERSION:
+        print('The SQLite DB schema version %d is newer than this script'
+              % version)
+        result = False
+    else:
+        result = True
+        while result and version < SCHEMAVERSION:
+            result = MIGRATIONS[version](conn)
+            version += 1
+    result = result and createmovetables(conn)
+    conn.commit()
     return result
 
 
-def runcmd(query, args=None):
+def runcmd(conn, query, args=None):
     """
     Run a specific command on the SQLite DB
     """
     args = args or []
     result = False
     try:
-        conn = connectdb()
-        if conn != None:
-            if tableexists('files'):
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute(query, args)
-                    conn.commit()
-                    cursor.close()
-                    result = True
-                except Exception as e:
-                    print("Query execution error: ", e)
+        conn.execute(query, args)
+        conn.commit()
+        result = True
     except Exception as e:
-        print(e)
+        print("Query execution error: ", e)
     return result
 
 
-def updatehashtable(fname, md5):
+def splitpath(fname):
+    """
+    Get the (folder, name) a file is stored under: the path of its
+    directory, ending with a path separator, and its name
+    """
+    dirname, name = os.path.split(fname)
+    return os.path.join(dirname, ''), name
+
+
+def updatehashtable(conn, fname, md5):
     """
     Update the SQLite File Table
     """
-    query = "UPDATE files SET md5 = ? WHERE fname = ?"
-    runcmd(query, (md5, fname))
+    filerow = fileindb(conn, fname)
+    if filerow is None:
+        return False
+    result = upserthashtable(conn, [(fname, md5) + tuple(filerow[1:])])
+    conn.commit()
+    return result
 
 
-def inserthashtable(fname, md5):
+def inserthashtable(conn, fname, md5):
     """
     Insert into the SQLite File Table
     """
-    query = "INSERT INTO files (fname, md5) VALUES (?,?)"
-    runcmd(query, (fname, md5))
+    return storefile(conn, (fname, md5) + statrow(None) + (None, None))
 
 
-def setuphashtable(fname, md5):
+def writerows(conn, rows):
     """
-    Setup's the Hash Table
+    Insert or update a batch of (fname, digest, size, mtime_ns, inode, dev,
+    algo, sample) rows, raising sqlite3.Error when it fails
+    The folders of the rows are added first, then the files rows find
+    their folder id through the idxfolderpath index. A row may carry a
+    list of (idx, digest) blocks as a ninth value, see writeblocks.
     """
-    createhashtable()
-    createhashtableidx()
-    inserthashtable(fname, md5)
+    blockrows = [row for row in rows if len(row) > 8 and row[8] is not None]
+    rows = [splitpath(row[0]) + tuple(row[1:8]) for row in rows]
+    folders = dict.fromkeys(row[0] for row in rows)
+    conn.executemany("INSERT OR IGNORE INTO folders (path) VALUES (?)",
+                     [(folder,) for folder in folders])
+    rolldirs(conn, filedeltas(digestchanges(conn, rows)))
+    query = ("INSERT INTO files (folder, name, digest, size, mtime_ns, "
+             "inode, dev, algo, sample) VALUES ((SELECT id FROM folders "
+             "WHERE path = ?),?,?,?,?,?,?,?,?) ON CONFLICT(folder, name) DO "
+             "UPDATE SET digest = excluded.digest, size = excluded.size, "
+             "mtime_ns = excluded.mtime_ns, inode = excluded.inode, "
+             "dev = excluded.dev, algo = excluded.algo, "
+             "sample = excluded.sample")
+    conn.executemany(query, rows)
+    if blockrows:
+        writeblocks(conn, blockrows)
 
 
-def md5indb(fname):
+def digestchanges(conn, rows):
     """
-    Checks if md5 hash tag exists in the SQLite DB
+    Yields a (folder, name, digest, count) change per digest that a batch
+    of (folder, name, digest, ...) rows about to be written brings in or
+    out of the files table (see filedeltas)
     """
-    query = "SELECT md5 FROM files WHERE fname = ?"
-    try:
-        conn = connectdb()
-        if not conn is None:
-            if tableexists('files'):
-                try:
-                    cursor = conn.cursor()
-                    args = (fname, )
-                    md5row = corecursor(conn, query, args).fetchone()
-                    if md5row:
-                        return md5row[0]
-                except Error as e:
-                    print(e)
-                finally:
-                    cursor.close()
-                    if conn != None:
-                        conn.commit()
-                        conn.close()
-                        #print("Closed connection to the database successfully")
-    except Error as e:
-        print(e)
-    return None
+    query = ("SELECT f.digest FROM files f JOIN folders d ON d.id = f.folder "
+             "WHERE d.path = ? AND f.name = ?")
+    written = {}
+    for row in rows:
+        key = row[:2]
+        if key in written:
+            old = written[key]
+        else:
+            old = conn.execute(query, key).fetchone()
+            old = old and old[0]
+        written[key] = row[2]
+        if old == row[2]:
+            continue
+        if old is not None:
+            yield key + (old, -1)
+        yield key + (row[2], 1)
 
 
-def haschanged(fname, md5):
+def entryhash(name, digest):
     """
-    Checks if a file has changed
+    Get the rollup hash of a file, or of a directory (its name then ends
+    with /), from its name and digest, as an int
     """
-    result = None
-    fileMD5inDB = md5indb(fname)
-    if fileMD5inDB is None:
-        setuphashtable(fname, md5)
-        result = 'IS_SETUP'
-        return result
-    elif fileMD5inDB != md5:
-        updatehashtable(fname, md5)
-        result = 'CHANGED'
-        return result
-    elif fileMD5inDB == md5:
-        updatehashtable(fname, md5)
-        result = 'NOT_CHANGED'
-        return result
-    else:
-        raise ValueError('A MD5 corner case might happened.')
-    return result
+    hasher = hashlib.blake2b(digest_size=ROLLUPSIZE)
+    hasher.update(name.encode('utf-8', 'surrogateescape') + b'\0')
+    hasher.update(digest)
+    return int.from_bytes(hasher.digest(), 'little')
 
 
-def getfileext(fname):
+def dirhash(name, rollup, count):
     """
-    Get the file name extension
+    Get the rollup hash of a subdirectory with this rollup and count of
+    files, 0 for an empty one
     """
-    return '.' + os.path.splitext(fname)[1][1:]
+    if not count:
+        return 0
+    return entryhash(name + '/', rollup.to_bytes(ROLLUPSIZE, 'little'))
 
 
-def getmoddate(fname):
+def filedeltas(changes, deltas=None):
     """
-    Get file modified date
+    Get the rollup deltas of files rows added (count 1) or removed (count
+    -1), given as (folder, name, digest, count): a dict of [xor, count]
+    per directory, added to deltas when it is given
+    """
+    deltas = {} if deltas is None else deltas
+    for folder, name, digest, count in changes:
+        delta = deltas.setdefault(folder, [0, 0])
+        delta[0] ^= entryhash(name, digest)
+        delta[1] += count
+    return deltas
+
+
+def parentdir(path):
+    """
+    Get the parent of a directory path ending with a path separator, None
+    at the top of the path
+    """
+    head = path[:-1] if len(path) > 1 else path
+    parent = os.path.dirname(head)
+    if not parent or parent == head:
+        return None
+    return os.path.join(parent, '')
+
+
+def rolldirs(conn, deltas):
+    """
+    Applies the deltas of filedeltas() to the rollups of the dirs table
+    The rollup of a directory is the XOR of the entryhash() of its files
+    and of the dirhash() of its subdirectories, and its count the number
+    of files below it, so a rollup answers whether anything below a
+    directory changed, and two trees with the same files have the same
+    rollups wherever they are. Directories are updated from the deepest
+    up, each passing the change of its dirhash() on to its parent, so
+    only the directories between the changed files and the root are
+    touched. Directories left without files are dropped.
+    """
+    heap = [(-len(path), path) for path in deltas]
+    heapq.heapify(heap)
+    query = "SELECT rollup, count FROM dirs WHERE path = ?"
+    while heap:
+        path = heapq.heappop(heap)[1]
+        xor, count = deltas.pop(path)
+        row = conn.execute(query, (path,)).fetchone()
+        oldrollup, oldcount = 0, 0
+        if row is not None:
+            oldrollup, oldcount = int.from_bytes(row[0], 'little'), row[1]
+        rollup = oldrollup ^ xor
+        if not xor and not count:
+            continue
+        parent = parentdir(path)
+        if oldcount + count > 0:
+            conn.execute("INSERT OR REPLACE INTO dirs (path, parent, rollup, count) VALUES (?,?,?,?)",
+                         (path, parent, rollup.to_bytes(ROLLUPSIZE, 'little'),
+                          oldcount + count))
+        else:
+            conn.execute("DELETE FROM dirs WHERE path = ?", (path,))
+        if parent is None:
+            continue
+        name = os.path.basename(path[:-1])
+        if parent not in deltas:
+            deltas[parent] = [0, 0]
+            heapq.heappush(heap, (-len(parent), parent))
+        deltas[parent][0] ^= (dirhash(name, oldrollup, oldcount) ^
+                              dirhash(name, rollup, oldcount + count))
+        deltas[parent][1] += count
+
+
+def dirrollup(conn, path):
+    """
+    Get the (rollup, count) of a directory, (None, 0) when there is no
+    file below it
+    """
+    query = "SELECT rollup, count FROM dirs WHERE path = ?"
+    row = conn.execute(query, (os.path.join(path, ''),)).fetchone()
+    return (row[0], row[1]) if row else (None, 0)
+
+
+def childdirs(conn, path):
+    """
+    Get the sorted (name, path) of the subdirectories of a directory that
+    have files below them; path ends with a path separator, as in dirs
+    """
+    query = "SELECT path FROM dirs WHERE parent = ? ORDER BY path"
+    return [(child[len(path):-1], child)
+            for (child,) in conn.execute(query, (path,))]
+
+
+def folderfiles(conn, path):
+    """
+    Get a dict of the digests of the files right in a directory by name
+    """
+    query = ("SELECT f.name, f.digest FROM files f JOIN folders d ON "
+             "d.id = f.folder WHERE d.path = ?")
+    return dict(conn.execute(query, (path,)))
+
+
+def writeblocks(conn, rows):
     """
+    Writes the blocks of files rows already stored (see writerows)
+    Only the (idx, digest) blocks that changed come with a row; the blocks
+    beyond the size of the file, or all of them when it is no longer
+    hashed as a Merkle tree, are dropped.
+    """
+    query = ("SELECT f.id FROM files f JOIN folders d ON d.id = f.folder "
+             "WHERE d.path = ? AND f.name = ?")
+    for row in rows:
+        fileid = conn.execute(query, splitpath(row[0])).fetchone()[0]
+        conn.execute("DELETE FROM blocks WHERE file = ? AND idx >= ?",
+                     (fileid, blockcount(row[2], row[6])))
+        conn.executemany("INSERT OR REPLACE INTO blocks (file, idx, digest) "
+                         "VALUES (?,?,?)",
+                         [(fileid, idx, digest) for idx, digest in row[8]])
+
+
+def fileblocks(conn, fname):
+    """
+    Get the list of the block digests stored for a file
+    """
+    query = ("SELECT b.digest FROM blocks b JOIN files f ON f.id = b.file "
+             "JOIN folders d ON d.id = f.folder WHERE d.path = ? AND "
+             "f.name = ? ORDER BY b.idx")
+    cursor = corecursor(conn, query, splitpath(fname))
+    if cursor is None:
+        return []
+    return [digest for (digest,) in cursor]
+
+
+def upserthashtable(conn, rows):
+    """
+    Insert or update a batch of (fname, digest, size, mtime_ns, inode, dev,
+    algo, sample) rows of the SQLite File Table
+    The rows are written with executemany() (see writerows) and are not
+    committed here: the caller commits once the whole scan pass is done.
+    """
+    result = False
     try:
-        mtime = os.path.getmtime(fname)
+        writerows(conn, rows)
+        result = True
     except Error as e:
-        print(e)
-    return mtime
+        print("Query execution error: ", e)
+    return result
 
 
-def md5short(fname):
+def flushbatch(conn, batch):
     """
-    Get md5 file hash tag
+    Writes the pending rows of a batch and empties it
     """
-    with open(fname, 'r') as open_file:
-        content = open_file.read()
-        hasher = hashlib.md5(content.encode('utf-8'))
-    md5value = hasher.hexdigest()
-    return md5value
+    result = True
+    if batch:
+        result = upserthashtable(conn, batch)
+        del batch[:]
+    return result
 
 
-def loadflds():
+def storefile(conn, row, batch=None):
     """
-    Write a Python function that can load and parse the configuration file.
-    This function should return the list of folders and list of extensions
-    to exclude for each folder (where applicable).
+    Queues a files row on batch, or writes it right away without one
     """
-    flds = []
-    ext = []
-    #config = getbasefile() + '.ini'
-    config = os.path.join(os.getcwd(), 'filechanges.ini')
-    if os.path.isfile(config):
-        cfile = open(config, 'r')
-        # Parse each config file line and get the folder and extensions
-        for dirline in cfile:
-            if len(dirline.split("|")) == 2:
-                extensions = dirline.split("|")[1]
-                entensions = list(set(extensions.split(",")))
-                entensions = [e.replace('\n', '') for e in entensions]
-                ext.append(entensions)
-                flds.append(dirline.split("|")[0])
-            else:
-                flds.append(dirline)
-                ext.append([])
-    return flds, ext
+    if batch is not None:
+        batch.append(row)
+        return True
+    result = upserthashtable(conn, [row])
+    conn.commit()
+    return result
 
 
-def checkfilechanges(folder, exclude, ws):
-    changed = False
-    """Checks for files changes"""
-    for subdir, dirs, files in os.walk(folder, topdown=True):
-        for fname in files:
-            origin = os.path.normpath(os.path.join(subdir, fname))
-            if os.path.isfile(origin):
-                # Get file extension and check if it is not excluded
-                fileext = getfileext(origin)
-                if fileext not in exclude:
-                    #print('===>', origin)
-                    # Get the file’s md5 hash
-                    filemd5 = md5short(origin)
-                    #print('File’s md5 hash is:', filemd5, md5indb(origin))
-                    # If the file has changed, add it to the Excel report
-                    file_changed = haschanged(origin, filemd5)
-                    if file_changed != 'NOT_CHANGED':
-                        changed = True
-                        now = getdt("%d-%b-%Y %H_%M_%S")
-                        dt = now.split(' ')
-                        rowxlsreport(ws, fname, origin, subdir, dt[0], dt[1])
-                        print(origin + ' changed now: ' + now)
-    return changed
+def fileindb(conn, fname):
+    """
+    Get the (digest, size, mtime_ns, inode, dev, algo, sample) row of a
+    file in the SQLite DB
+    """
+    query = "SELECT digest, size, mtime_ns, inode, dev, algo, sample FROM files WHERE folder = (SELECT id FROM folders WHERE path = ?) AND name = ?"
+    cursor = corecursor(conn, query, splitpath(fname))
+    if cursor is not None:
+        filerow = cursor.fetchone()
+        cursor.close()
+        return filerow
+    return None
 
 
-def runfilechanges(ws):
-    changed = False
-    # Invoke the function that loads and parses the config file
-    currentpaths, bannedextensions = loadflds()
-    for i, fld in enumerate(currentpaths):
-        #print('List banned extensions: ', bannedextensions[i], '<--->', fld)
-        # Invoke the function that checks each folder for file changes
-        if checkfilechanges(fld, bannedextensions[i], ws):
-            changed = True
-    return changed
+def md5indb(conn, fname):
+    """
+    Checks if md5 hash tag exists in the SQLite DB
+    """
+    query = "SELECT digest FROM files WHERE folder = (SELECT id FROM folders WHERE path = ?) AND name = ?"
+    cursor = corecursor(conn, query, splitpath(fname))
+    if cursor is not None:
+        md5row = cursor.fetchone()
+        cursor.close()
+        if md5row:
+            return md5row[0]
+    return None
 
 
-def getdt(frmt):
-    today = datetime.today()
-    return today.strftime(frmt)
+def dbrows(conn, folder, metrics=None, after=None):
+    """
+    Yields the (folder, name, digest, size, mtime_ns, inode, dev, algo,
+    sample) rows of the files below a folder, in (folder, name) order (see
+    splitpath), which is the order scantree() walks a tree in
+    The rows are read through one range query on the folders path index
+    joined with the files index, so the DB side of a merge-join (see
+    mergejoin) is never held in memory nor sorted. They are fetched
+    BATCHSIZE at a time, each fetch being timed with metrics. With after,
+    the directory a resumed scan stopped at (see savecheckpoint), only
+    the rows of the directories past it are read.
+    """
+    metrics = metrics or ScanMetrics()
+    query = ("SELECT d.path, f.name, f.digest, f.size, f.mtime_ns, f.inode, "
+             "f.dev, f.algo, f.sample FROM folders d JOIN files f ON "
+             "f.folder = d.id WHERE d.path %s ? AND d.path < ? "
+             "ORDER BY d.path, f.name")
+    prefix = os.path.join(os.path.normpath(folder), '')
+    low, high = prefixrange(prefix)
+    if after is not None and after >= low:
+        query, low = query % '>', after
+    else:
+        query = query % '>='
+    cursor = corecursor(conn, query, (low, high))
+    if cursor is not None:
+        fetch = lambda: cursor.fetchmany(BATCHSIZE)
+        for rows in metrics.timed(iter(fetch, []), 'db'):
+            yield from rows
+        cursor.close()
+
+
+def flushmoves(conn, gone, added):
+    """
+    Writes the queued (fname, md5, size, algo) rows of the gone and new
+    files to their temporary tables (or to the tables of a shard spool,
+    see openspool) and empties both lists
+    """
+    result = False
+    try:
+        conn.executemany("INSERT OR REPLACE INTO gonefiles (fname, md5, size, algo) VALUES (?,?,?,?)", gone)
+        conn.executemany("INSERT INTO newfiles (fname, md5, size, algo) VALUES (?,?,?,?)", added)
+        result = True
+    except Error as e:
+        print("Query execution error: ", e)
+    del gone[:]
+    del added[:]
+    return result
 
 
-def startxlsreport():
-    # Create the workbook, get the hostname and current DateTime
-    wb = Workbook()
-    ws = wb.active
-    ws.title = socket.gethostname()
+def pairmoves(conn):
+    """
+    Pairs the gone and new files collected by flushmoves()
+    Yields (change, fname, detail) for each of them: RENAMED for a new
+    file with the hash, size and algorithm of a gone one (detail is the
+    former name), IS_SETUP for the other new files and DELETED for the
+    other gone files. Empty files are never paired. Once all is yielded
+    the rows of the gone files are removed from the files table, along
+    with their blocks and the folders left without files, and both
+    temporary tables are emptied.
+    """
+    find = ("SELECT rowid, fname FROM temp.gonefiles WHERE md5 = ? AND "
+            "size = ? AND algo IS ? AND paired = 0 ORDER BY fname LIMIT 1")
+    cursor = corecursor(conn, "SELECT EXISTS (SELECT 1 FROM temp.gonefiles)")
+    anygone = cursor is not None and cursor.fetchone()[0]
+    cursor = corecursor(conn, "SELECT fname, md5, size, algo FROM temp.newfiles ORDER BY rowid")
+    for fname, md5, size, algo in cursor or ():
+        match = None
+        if anygone and size:
+            match = conn.execute(find, (md5, size, algo)).fetchone()
+        if match is None:
+            yield 'IS_SETUP', fname, ''
+            continue
+        conn.execute("UPDATE temp.gonefiles SET paired = 1 WHERE rowid = ?",
+                     (match[0],))
+        yield 'RENAMED', fname, match[1]
+    if anygone:
+        cursor = corecursor(conn, "SELECT fname FROM temp.gonefiles WHERE paired = 0 ORDER BY fname")
+        for (fname,) in cursor or ():
+            yield 'DELETED', fname, ''
+    try:
+        if anygone:
+            cursor = conn.execute("SELECT fname, md5 FROM temp.gonefiles")
+            rolldirs(conn, filedeltas(splitpath(fname) + (md5, -1)
+                                      for fname, md5 in cursor))
+            cursor = conn.execute("SELECT fname FROM temp.gonefiles")
+            conn.executemany("DELETE FROM blocks WHERE file = (SELECT id FROM files WHERE folder = (SELECT id FROM folders WHERE path = ?) AND name = ?)",
+                             (splitpath(fname) for (fname,) in cursor))
+            cursor = conn.execute("SELECT fname FROM temp.gonefiles")
+            conn.executemany("DELETE FROM files WHERE folder = (SELECT id FROM folders WHERE path = ?) AND name = ?",
+                             (splitpath(fname) for (fname,) in cursor))
+            dropfolders(conn)
+        conn.execute("DELETE FROM temp.gonefiles")
+        conn.execute("DELETE FROM temp.newfiles")
+    except Error as e:
+        print("Query execution error: ", e)
 
-    st = getdt("%d-%b-%Y %H_%M_%S")
 
-    headerxlsreport(ws)
+def dropfolders(conn):
+    """
+    Deletes the folders rows no files row nor history row refers to
+    """
+    conn.execute("DELETE FROM folders WHERE NOT EXISTS (SELECT 1 FROM files WHERE files.folder = folders.id) AND NOT EXISTS (SELECT 1 FROM history WHERE history.folder = folders.id)")
 
-    return wb, ws, st
 
+def writehistory(conn, rows):
+    """
+    Appends (stamp, path, change, detail) rows to the history table, stamp
+    being in seconds since the epoch
+    """
+    rows = [(stamp,) + splitpath(path) + (change, detail)
+            for stamp, path, change, detail in rows]
+    folders = dict.fromkeys(row[1] for row in rows)
+    conn.executemany("INSERT OR IGNORE INTO folders (path) VALUES (?)",
+                     [(folder,) for folder in folders])
+    conn.executemany("INSERT INTO history (stamp, folder, name, change, detail) VALUES (?, (SELECT id FROM folders WHERE path = ?), ?, ?, ?)",
+                     rows)
 
-def endxlsreport(wb, st):
-    """Finalize the creation of the Excel report"""
-    dt = "_from_" + st + "_to_" + getdt("%d-%b-%Y %H_%M_%S")
-    wb.save(f"REPORT{dt}.xlsx")
 
+def reportstamp(d, t):
+    """
+    Get the stamp of the date and time columns of a report row, None when
+    they can't be read
+    """
+    try:
+        return datetime.strptime(d + ' ' + t, "%d-%b-%Y %H_%M_%S").timestamp()
+    except (TypeError, ValueError):
+        return None
 
-def headerxlsreport(ws):
-    ws.cell(row=1, column=1, value="File Name")
-    ws.cell(row=1, column=2, value="Full File Name")
-    ws.cell(row=1, column=3, value="Folder Name")
-    ws.cell(row=1, column=4, value="Date")
-    ws.cell(row=1, column=5, value="Time")
 
-    ft = Font(color="000000", bold=True)
-    ws["A1"].font = ft
-    ws["A2"].font = ft
-    ws["A3"].font = ft
-    ws["A4"].font = ft
-    ws["A6"].font = ft
+def historyrows(conn, path, since=None, until=None):
+    """
+    Yields the (stamp, change, path, detail) history rows of the files
+    below a directory, or of the file at path, found from since (included)
+    to until (excluded), in the order they were found
+    The rows are either read from the time range of idxhistorystamp, or
+    from the history of each folder of the tree in idxhistoryfolder, the
+    folders being a range of the folders path index, whichever reads
+    fewer entries: as ids grow with the stamps, two seeks on the stamps
+    tell about how many rows the time range holds, which is weighed
+    against the number of folders of the tree.
+    """
+    since = since if since is not None else float('-inf')
+    until = until if until is not None else float('inf')
+    path = os.path.normpath(path)
+    low, high = prefixrange(os.path.join(path, ''))
+    first = conn.execute("SELECT id FROM history WHERE stamp >= ? ORDER BY stamp LIMIT 1",
+                         (since,)).fetchone()
+    last = conn.execute("SELECT id FROM history WHERE stamp < ? ORDER BY stamp DESC LIMIT 1",
+                        (until,)).fetchone()
+    spanned = last[0] - first[0] + 1 if first and last else 0
+    folders = conn.execute("SELECT count(*) FROM (SELECT 1 FROM folders WHERE path >= ? AND path < ? LIMIT ?)",
+                           (low, high, spanned + 1)).fetchone()[0]
+    columns = "SELECT h.id, h.stamp, h.change, d.path || h.name, h.detail FROM "
+    if folders <= spanned:
+        tree = (columns + "folders d CROSS JOIN history h INDEXED BY "
+                "idxhistoryfolder ON h.folder = d.id WHERE d.path >= ? AND "
+                "d.path < ? AND h.stamp >= ? AND h.stamp < ?")
+        args = (low, high, since, until)
+    else:
+        tree = (columns + "history h INDEXED BY idxhistorystamp CROSS JOIN "
+                "folders d ON d.id = h.folder WHERE h.stamp >= ? AND "
+                "h.stamp < ? AND d.path >= ? AND d.path < ?")
+        args = (since, until, low, high)
+    single = (columns + "folders d CROSS JOIN history h INDEXED BY "
+              "idxhistoryfolder ON h.folder = d.id WHERE d.path = ? AND "
+              "h.name = ? AND h.stamp >= ? AND h.stamp < ?")
+    cursor = conn.execute(tree + ' UNION ALL ' + single + ' ORDER BY 2, 1',
+                          args + splitpath(path) + (since, until))
+    for rows in iter(lambda: cursor.fetchmany(BATCHSIZE), []):
+        for row in rows:
+            yield row[1:]
 
 
-def getlastrow(ws):
-    rw = 1
-    for cell in ws["A"]:
-        if cell.value is None:
-            break
-        else:
-            rw += 1
-    return rw
+def prunehistory(conn, days=0, compactdays=0):
+    """
+    Applies the retention policy of the history table and returns how
+    many rows it deleted
+    The rows older than days are deleted, and of those older than
+    compactdays only the last change of each file per day (UTC) is kept;
+    0 keeps them all.
+    """
+    deleted = 0
+    now = time.time()
+    try:
+        if days:
+            deleted += conn.execute("DELETE FROM history WHERE stamp < ?",
+                                    (now - days * 86400,)).rowcount
+        if compactdays:
+            cutoff = now - compactdays * 86400
+            deleted += conn.execute("DELETE FROM history WHERE stamp < ? AND id NOT IN (SELECT max(id) FROM history WHERE stamp < ? GROUP BY folder, name, CAST(stamp / 86400 AS INTEGER))",
+                                    (cutoff, cutoff)).rowcount
+        dropfolders(conn)
+        conn.commit()
+    except Error as e:
+        conn.rollback()
+        print("Query execution error: ", e)
+    return deleted
 
 
-def rowxlsreport(ws, fn, ffn, fld, d, t):
-    row = getlastrow(ws)
-    ws.cell(row=row, column=1, value=fn)
-    ws.cell(row=row, column=2, value=ffn)
-    ws.cell(row=row, column=3, value=fld)
-    ws.cell(row=row, column=4, value=d)
-    ws.cell(row=row, column=5, value=t)
+def sizebuckets(conn, path=None, minsize=1):
+    """
+    Yields a (size, rows) bucket per size shared by several files of at
+    least minsize bytes below path (all files when None), rows being the
+    (path, filerow) of each file, filerow as fileindb() gets it without
+    the sample
+    Only the DB is read: the shared sizes are found first, then the rows
+    of those files alone, in decreasing size order.
+    """
+    scope, args = '', ()
+    if path is not None:
+        scope = ' AND d.path >= ? AND d.path < ?'
+        args = prefixrange(os.path.join(os.path.normpath(path), ''))
+    query = ("SELECT f.size, d.path || f.name, f.digest, f.size, f.mtime_ns, "
+             "f.inode, f.dev, f.algo FROM files f JOIN folders d ON d.id = "
+             "f.folder WHERE f.size IN (SELECT f.size FROM files f JOIN "
+             "folders d ON d.id = f.folder WHERE f.size >= ?%s GROUP BY "
+             "f.size HAVING count(*) > 1)%s ORDER BY f.size DESC" %
+             (scope, scope))
+    cursor = conn.execute(query, (minsize,) + args + args)
+    bucket, rows = None, []
+    for batch in iter(lambda: cursor.fetchmany(BATCHSIZE), []):
+        for row in batch:
+            if row[0] != bucket:
+                if rows:
+                    yield bucket, rows
+                bucket, rows = row[0], []
+            rows.append((row[1], row[2:]))
+    if rows:
+        yield bucket, rows
 
 
-def execute(args):
-    # Start the creation of the Excel report
-    wb, ws, st = startxlsreport()
-    if '--loop' in args:
+def bucketgroups(size, rows, counts):
+    """
+    Get the groups of files of a size bucket (see sizebuckets) that have
+    the same content, as lists of lists of paths, the paths of a list
+    being hard links to the same file
+    The digest of the DB row of a file is used as it is while its stat
+    data is unchanged. The other files are hashed with the algorithm most
+    of the bucket was stored with, files larger than PREFIXSIZE only when
+    their first PREFIXSIZE bytes match those of another file of the
+    bucket. Files gone or of another size since the last scan are left
+    out. counts adds up the prefixes and files hashed and the bytes read.
+    """
+    links = {}
+    known = {}
+    for fname, filerow in rows:
         try:
-            while True:
-                changed = runfilechanges(ws)
-        except KeyboardInterrupt:
-            # Check for a keyboard interruption to stop the script
-            print('Program stopped!!')
-            pass
-    else:
-        changed = runfilechanges(ws)
-    # Finalize the creation of the Excel report
-    endxlsreport(wb, st)
+            st = os.stat(fname)
+        except OSError:
+            continue
+        if st.st_size != size:
+            continue
+        ident = (st.st_dev, st.st_ino)
+        if ident in links:
+            links[ident].append(fname)
+            continue
+        links[ident] = [fname]
+        if statunchanged(filerow, st):
+            known[ident] = (rowalgo(filerow), filerow[0])
+    if len(links) < 2:
+        return []
+    algos = collections.Counter(algo for algo, _ in known.values())
+    algo = algos.most_common(1)[0][0] if algos else DEFAULTALGO
+    digests = {ident: digest for ident, (stored, digest) in known.items()
+               if stored == algo}
+    unknown = [ident for ident in links if ident not in digests]
+    if unknown and size > PREFIXSIZE:
+        prefixes = {}
+        for ident in links:
+            try:
+                prefixes[ident] = prefixdigest(links[ident][0], algo)
+                counts['prefixes'] += 1
+                counts['bytes'] += PREFIXSIZE
+            except OSError as e:
+                print(e)
+        shared = collections.Counter(prefixes.values())
+        unknown = [ident for ident in unknown
+                   if shared[prefixes.get(ident)] > 1]
+    for ident in unknown:
+        try:
+            digests[ident] = hashdigests(links[ident][0], algo)[0]
+            counts['hashed'] += 1
+            counts['bytes'] += size
+        except OSError as e:
+            print(e)
+    groups = {}
+    for ident, digest in digests.items():
+        groups.setdefault(digest, []).append(sorted(links[ident]))
+    return [sorted(group) for group in groups.values() if len(group) > 1]
+
+
+def duplicategroups(conn, path=None, minsize=1, counts=None):
+    """
+    Yields a (size, group) per set of files of the same content below
+    path (see bucketgroups)
+    Files are only compared to the files of the same size, so those of a
+    size no other file has are never read.
+    """
+    if counts is None:
+        counts = {'prefixes': 0, 'hashed': 0, 'bytes': 0}
+    for size, rows in sizebuckets(conn, path, minsize):
+        for group in bucketgroups(size, rows, counts):
+            yield size, group
+
+
+def movemarks(conn):
+    """
+    Get the last rowid of each temporary move table, by kind of move, for
+    savecheckpoint() to copy only the rows added after them
+    """
+    return {kind: conn.execute("SELECT max(rowid) FROM temp.%s" % table).fetchone()[0] or 0
+            for kind, table in (('gone', 'gonefiles'), ('new', 'newfiles'))}
+
+
+def savecheckpoint(conn, folder, lastdir, copied):
+    """
+    Commits the scan pass so far as the checkpoint of folder, whose walk
+    is done up to the directory lastdir
+    The rows of the pass are written by then (see checkfilechanges), and
+    the gone and new files not paired yet are copied from the temporary
+    move tables to checkpointmoves, past the rowids of copied (see
+    movemarks), so that resumemoves() can bring them back. A scan resumed
+    with --resume goes on after lastdir (see startcheckpoints).
+    """
+    result = False
+    try:
+        marks = movemarks(conn)
+        for kind, table in (('gone', 'gonefiles'), ('new', 'newfiles')):
+            conn.execute("INSERT INTO checkpointmoves (folder, kind, fname, md5, size, algo) SELECT ?, ?, fname, md5, size, algo FROM temp.%s WHERE rowid > ? ORDER BY rowid" % table,
+                         (folder, kind, copied[kind]))
+        copied.update(marks)
+        conn.execute("UPDATE checkpoints SET lastdir = ?, updated = ? WHERE folder = ?",
+                     (lastdir, time.time(), folder))
+        conn.commit()
+        result = True
+    except Error as e:
+        print("Query execution error: ", e)
+    return result
+
+
+def resumemoves(conn, folder):
+    """
+    Brings the gone and new files of folder saved by its checkpoint back
+    into the temporary move tables, in the order they were found
+    """
+    result = False
+    query = ("SELECT fname, md5, size, algo FROM checkpointmoves WHERE "
+             "folder = ? AND kind = ? ORDER BY rowid")
+    try:
+        conn.executemany("INSERT OR REPLACE INTO temp.gonefiles (fname, md5, size, algo) VALUES (?,?,?,?)",
+                         conn.execute(query, (folder, 'gone')).fetchall())
+        conn.executemany("INSERT INTO temp.newfiles (fname, md5, size, algo) VALUES (?,?,?,?)",
+                         conn.execute(query, (folder, 'new')).fetchall())
+        result = True
+    except Error as e:
+        print("Query execution error: ", e)
+    return result
+
+
+def startcheckpoints(conn, folders, settings):
+    """
+    Starts the checkpoints of a scan pass over folders
+    Returns the set of the folders the pass skips and a dict of the
+    directory each folder with saved gone and new files (see resumemoves)
+    is walked after, None to walk it all. With settings.resume, the pass
+    goes on from the checkpoint of the last interrupted one: the folders
+    it completed are skipped and those it left halfway are resumed after
+    the last directory they were done with. Otherwise the pass starts
+    over, but the files the interrupted one had not paired yet are still
+    paired. Then, with settings.checkpoint, every folder gets its row in
+    checkpoints.
+    """
+    done, afters = set(), {}
+    rows = conn.execute("SELECT folder, lastdir, done FROM checkpoints").fetchall()
+    for folder, lastdir, isdone in rows:
+        if not settings.resume:
+            afters[folder] = None
+        elif isdone:
+            done.add(folder)
+        elif lastdir is not None:
+            afters[folder] = lastdir
+    if rows and settings.resume:
+        print('Resuming the interrupted scan: %d folders done, %d resumed'
+              % (len(done), len(afters)))
+    elif rows:
+        print('The interrupted scan starts over, see --resume')
+        conn.execute("UPDATE checkpoints SET lastdir = NULL, done = 0")
+    # Only the first pass of --loop is resumed
+    settings.resume = False
+    if settings.checkpoint:
+        conn.executemany("INSERT OR IGNORE INTO checkpoints (folder) VALUES (?)",
+                         [(folder,) for folder in folders])
+    return done, afters
+
+
+def endcheckpoint(conn, folder, batch, report, settings):
+    """
+    Commits a checkpoint once a folder of the scan pass is done
+    """
+    if settings.checkpoint:
+        flushbatch(conn, batch)
+        report.flush()
+        conn.execute("UPDATE checkpoints SET done = 1, lastdir = NULL, updated = ? WHERE folder = ?",
+                     (time.time(), folder))
+        conn.execute("DELETE FROM checkpointmoves WHERE folder = ?", (folder,))
+        conn.commit()
+
+
+def clearcheckpoints(conn):
+    """
+    Drops the checkpoint of the scan pass, once it is over
+    """
+    conn.execute("DELETE FROM checkpoints")
+    conn.execute("DELETE FROM checkpointmoves")
+
+
+def haschanged(conn, fname, md5, batch=None, st=None, algo=DEFAULTALGO,
+               prevmd5=None):
+    """
+    Checks if a file has changed
+    See comparefile(), the DB row of the file is looked up here.
+    """
+    filerow = fileindb(conn, fname)
+    return comparefile(conn, fname, md5, filerow, batch, st, algo, prevmd5)
+
+
+def comparefile(conn, fname, md5, filerow, batch=None, st=None,
+                algo=DEFAULTALGO, prevmd5=None, sample=None, blocks=None,
+                appended=False):
+    """
+    Checks if a file has changed against its DB row filerow (see fileindb)
+    md5 is the file digest computed with algo. When the DB row was hashed
+    with another algorithm, prevmd5 is the digest computed with that one
+    (None if it was not computed, then the stat data decides) and the row
+    is moved over to algo without the file being flagged as CHANGED.
+    New and changed files are queued on batch when one is given (see
+    flushbatch), otherwise they are written right away. Unchanged files
+    are only written when their stat data (st) or their sampled
+    fingerprint (sample, see samplefile) moved on, so that the next pass
+    can skip hashing them again. blocks are the (idx, digest) blocks of a
+    file hashed as a Merkle tree that changed (see writeblocks); a file
+    that changed is APPENDED rather than CHANGED when appended tells it
+    was only appended to (see blockdiff).
+    """
+    result = None
+    newrow = (fname, md5) + statrow(st) + (algo, sample, blocks)
+    if filerow is None:
+        storefile(conn, newrow, batch)
+        result = 'IS_SETUP'
+        return result
+    elif rowalgo(filerow) != algo:
+        if prevmd5 is None:
+            unchanged = statunchanged(filerow, st)
+        else:
+            unchanged = prevmd5 == filerow[0]
+        storefile(conn, newrow, batch)
+        result = 'NOT_CHANGED' if unchanged else 'CHANGED'
+        return result
+    elif filerow[0] != md5:
+        storefile(conn, newrow, batch)
+        result = 'APPENDED' if appended else 'CHANGED'
+        return result
+    elif filerow[0] == md5:
+        if ((st is not None and not statunchanged(filerow, st)) or
+                sample != filerow[6]):
+            storefile(conn, newrow, batch)
+        result = 'NOT_CHANGED'
+        return result
+    else:
+        raise ValueError('A MD5 corner case might happened.')
+    return result
+
+
+def int64(value):
+    """
+    Maps an unsigned 64-bit stat field onto SQLite's signed INTEGER range
+    """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def statrow(st):
+    """
+    Get the (size, mtime_ns, inode, dev) values stored for an os.stat result
+    """
+    if st is None:
+        return (None, None, None, None)
+    return (st.st_size, st.st_mtime_ns, int64(st.st_ino), int64(st.st_dev))
+
+
+def statunchanged(filerow, st):
+    """
+    Checks if the stat data stored for a file still matches the file
+    """
+    return filerow is not None and tuple(filerow[1:5]) == statrow(st)
+
+
+def rowalgo(filerow):
+    """
+    Get the hash algorithm a files row was hashed with
+    """
+    return filerow[5] or DEFAULTALGO
+
+
+def getfileext(fname):
+    """
+    Get the file name extension
+    """
+    return '.' + os.path.splitext(fname)[1][1:]
+
+
+def getmoddate(fname):
+    """
+    Get file modified date
+    """
+    try:
+        mtime = os.path.getmtime(fname)
+    except Error as e:
+        print(e)
+    return mtime
+
+
+def getreadbuffer():
+    """
+    Get the read buffer of the current thread, allocated once and reused
+    """
+    buf = getattr(READBUFFERS, 'buf', None)
+    if buf is None:
+        buf = READBUFFERS.buf = memoryview(bytearray(READBLOCKSIZE))
+    return buf
+
+
+def hashfile(hashers, open_file):
+    """
+    Feeds the content of a file opened in binary mode to a list of hashers
+    Large files are hashed through mmap, others are read with readinto()
+    in fixed-size blocks, so memory use does not depend on the file size.
+    """
+    size = os.fstat(open_file.fileno()).st_size
+    if size >= MMAPTHRESHOLD:
+        # Map one window at a time so the mapped pages stay bounded too
+        for offset in range(0, size, MMAPTHRESHOLD):
+            length = min(MMAPTHRESHOLD, size - offset)
+            with mmap.mmap(open_file.fileno(), length, offset=offset,
+                           access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    for pos in range(0, length, READBLOCKSIZE):
+                        for hasher in hashers:
+                            hasher.update(view[pos:pos + READBLOCKSIZE])
+                finally:
+                    view.release()
+        return hashers
+    buf = getreadbuffer()
+    while True:
+        count = open_file.readinto(buf)
+        if not count:
+            break
+        for hasher in hashers:
+            hasher.update(buf[:count])
+    return hashers
+
+
+def gethasher(algo):
+    """
+    Get a new hasher for an algorithm name of HASHERS
+    A digest size in bytes can follow the name of the blake2 algorithms,
+    e.g. blake2b:16
+    """
+    name, _, digestsize = algo.partition(':')
+    if name not in HASHERS:
+        raise ValueError('Unknown hash algorithm: ' + algo)
+    if digestsize:
+        if not name.startswith('blake2'):
+            raise ValueError('Digest size is not tunable for: ' + algo)
+        return HASHERS[name](digest_size=int(digestsize))
+    return HASHERS[name]()
+
+
+def blockalgo(algo):
+    """
+    Get the (algorithm, block size) of an algorithm name as stored in the
+    DB, the block size being None unless the files are hashed as a Merkle
+    tree of blocks, e.g. md5/1048576 (see the blocks folder option)
+    """
+    name, _, blocksize = algo.partition('/')
+    return name, int(blocksize) if blocksize else None
+
+
+def folderalgo(options):
+    """
+    Get the algorithm name the files of a folder are stored with
+    """
+    algo = options.get('hash', DEFAULTALGO)
+    if 'blocks' in options:
+        algo = '%s/%d' % (algo, parsesize(options['blocks']))
+    return algo
+
+
+def blockcount(size, algo):
+    """
+    Get the number of blocks of a file of this size, 0 when algo does not
+    hash it as a Merkle tree
+    """
+    blocksize = blockalgo(algo or DEFAULTALGO)[1]
+    if not blocksize or not size:
+        return 0
+    return -(-size // blocksize)
+
+
+def merkleroot(blocks, algo):
+    """
+    Get the root of the Merkle tree of the block digests of a file
+    The nodes of each level are hashed together by pairs, an odd one out
+    moving up as it is; a file of a single block has the digest of its
+    content, an empty one the digest of nothing.
+    """
+    name = blockalgo(algo)[0]
+    level = list(blocks)
+    if not level:
+        return gethasher(name).digest()
+    while len(level) > 1:
+        parents = []
+        for i in range(0, len(level) - 1, 2):
+            hasher = gethasher(name)
+            hasher.update(level[i])
+            hasher.update(level[i + 1])
+            parents.append(hasher.digest())
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+def hashblocks(fname, algo, prevblocks=(), prevsize=0, appends=False):
+    """
+    Get the (blocks, tailok) of a file hashed as a Merkle tree: the list
+    of the raw digests of its blocks, and whether the end of its previous
+    content (prevblocks) still hashes to the digest it had, i.e. whether
+    the file may only have been appended to. That end is the first
+    prevsize % blocksize bytes of the block the previous content ended
+    in, or the whole block before when it ended on a block boundary.
+    With appends, when the file grew, the blocks before that one
+    are taken from prevblocks instead of being read, so only the bytes
+    appended and the end of the previous content are read; the whole
+    file is read when the end of the previous content changed.
+    """
+    name, blocksize = blockalgo(algo)
+    last, partial = divmod(prevsize, blocksize)
+    if not partial and last:
+        last, partial = last - 1, blocksize
+    tailok = prevsize == 0
+    buf = getreadbuffer()
+    with open(fname, 'rb') as open_file:
+        size = os.fstat(open_file.fileno()).st_size
+        start = last if appends and prevblocks and size > prevsize else 0
+        blocks = list(prevblocks[:start])
+        open_file.seek(start * blocksize)
+        for index in itertools.count(start):
+            hasher = gethasher(name)
+            tail = gethasher(name) if index == last and partial else None
+            read = 0
+            while read < blocksize:
+                count = open_file.readinto(buf[:min(len(buf), blocksize - read)])
+                if not count:
+                    break
+                hasher.update(buf[:count])
+                if tail is not None and read < partial:
+                    tail.update(buf[:min(count, partial - read)])
+                read += count
+            if not read:
+                break
+            if tail is not None and read >= partial and last < len(prevblocks):
+                tailok = tail.digest() == prevblocks[last]
+            blocks.append(hasher.digest())
+            if read < blocksize:
+                break
+    if start and not tailok:
+        return hashblocks(fname, algo, prevblocks, prevsize)
+    return blocks, tailok
+
+
+def hashdigests(fname, *algos):
+    """
+    Get the raw file digests of one or more algorithms, reading the file
+    once for all those that are not Merkle trees; they are stored as they
+    are in the DB
+    """
+    linear = [algo for algo in algos if blockalgo(algo)[1] is None]
+    with open(fname, 'rb') as open_file:
+        hashers = hashfile([gethasher(algo) for algo in linear], open_file)
+    digests = dict(zip(linear, (hasher.digest() for hasher in hashers)))
+    for algo in algos:
+        if algo not in digests:
+            digests[algo] = merkleroot(hashblocks(fname, algo)[0], algo)
+    return [digests[algo] for algo in algos]
+
+
+def blockdiff(prevblocks, blocks, blocksize, prevsize, size, tailok):
+    """
+    Compares the block digests of a file to those stored for it
+    Returns (first, appended, ranges): the index of the first block that
+    differs, whether the file was only appended to, and the (start, end)
+    byte ranges that changed.
+    """
+    common = min(len(prevblocks), len(blocks))
+    first = next((i for i in range(common) if prevblocks[i] != blocks[i]),
+                 common)
+    if (size > prevsize and tailok and first >= prevsize // blocksize and
+            (prevblocks or not prevsize)):
+        return first, True, [(prevsize, size)]
+    ranges = []
+    end = max(size, prevsize)
+    for i in range(first, max(len(prevblocks), len(blocks))):
+        if i < common and prevblocks[i] == blocks[i]:
+            continue
+        start = i * blocksize
+        if ranges and ranges[-1][1] == start:
+            start = ranges.pop()[0]
+        ranges.append((start, min((i + 1) * blocksize, end)))
+    return first, False, ranges
+
+
+def rangesdetail(ranges):
+    """
+    Get the Detail of a report row listing changed byte ranges
+    """
+    detail = ', '.join('%d-%d' % byterange for byterange in ranges[:MAXRANGES])
+    if len(ranges) > MAXRANGES:
+        detail += ' (+%d more)' % (len(ranges) - MAXRANGES)
+    return detail
+
+
+def samplefile(fname, algo, blocks=DEFAULTSAMPLEBLOCKS):
+    """
+    Get the sampled fingerprint of a file: the raw digest of its size, its
+    first and last SAMPLEBLOCKSIZE bytes and blocks more blocks spread
+    evenly in between
+    At most (blocks + 2) * SAMPLEBLOCKSIZE bytes are read, whatever the
+    size of the file.
+    """
+    hasher = gethasher(algo)
+    buf = getreadbuffer()[:SAMPLEBLOCKSIZE]
+    with open(fname, 'rb') as open_file:
+        size = os.fstat(open_file.fileno()).st_size
+        hasher.update(struct.pack('<q', size))
+        last = max(size - SAMPLEBLOCKSIZE, 0)
+        for i in range(blocks + 2):
+            open_file.seek(last * i // (blocks + 1))
+            count = open_file.readinto(buf)
+            hasher.update(buf[:count])
+    return hasher.digest()
+
+
+def prefixdigest(fname, algo):
+    """
+    Get the raw digest of the first PREFIXSIZE bytes of a file
+    """
+    hasher = gethasher(blockalgo(algo)[0])
+    buf = getreadbuffer()[:PREFIXSIZE]
+    with open(fname, 'rb') as open_file:
+        count = open_file.readinto(buf)
+        hasher.update(buf[:count])
+    return hasher.digest()
+
+
+def hashshort(fname, *algos):
+    """
+    Get the file hash tags of one or more algorithms, reading the file once
+    """
+    return [digest.hex() for digest in hashdigests(fname, *algos)]
+
+
+def md5short(fname):
+    """
+    Get md5 file hash tag
+    """
+    md5value = hashshort(fname, 'md5')[0]
+    return md5value
+
+
+def prefixrange(prefix):
+    """
+    Get the (low, high) bounds of the strings starting with prefix
+    Used as path >= low AND path < high, the range is served by the
+    folders path index. prefix must end with a path separator.
+    """
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class Snapshot:
+    """
+    The files rows under a folder, loaded with one range query
+    Rows are kept in a dict keyed by their interned path relative to the
+    folder. Each value packs size, mtime_ns, inode, dev, the index of the
+    hash algorithm and the digest size with SNAPSHOTROW, followed by the
+    raw digest and sample bytes, so millions of rows take far less memory
+    than tuples would. get() unpacks a row into the shape returned by
+    fileindb() and drops it, so once a folder was walked only the rows of
+    the files that were not seen are left.
+    """
+
+    def __init__(self, conn, folder):
+        self.prefix = os.path.join(os.path.normpath(folder), '')
+        self.algos = []
+        self.rows = {}
+        query = ("SELECT d.path, f.name, f.digest, f.size, f.mtime_ns, "
+                 "f.inode, f.dev, f.algo, f.sample FROM folders d JOIN files "
+                 "f ON f.folder = d.id WHERE d.path >= ? AND d.path < ?")
+        start = len(self.prefix)
+        cursor = corecursor(conn, query, prefixrange(self.prefix))
+        if cursor is not None:
+            for filerow in cursor:
+                key = sys.intern(filerow[0][start:] + filerow[1])
+                self.rows[key] = self.pack(filerow[2:])
+            cursor.close()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def pack(self, filerow):
+        digest, size, mtime_ns, inode, dev, algo, sample = filerow
+        if algo not in self.algos:
+            self.algos.append(algo)
+        if size is None:
+            size = mtime_ns = inode = dev = -1
+        return SNAPSHOTROW.pack(size, mtime_ns, inode, dev,
+                                self.algos.index(algo),
+                                len(digest)) + digest + (sample or b'')
+
+    def unpack(self, packed):
+        (size, mtime_ns, inode, dev, algo,
+         digestsize) = SNAPSHOTROW.unpack_from(packed)
+        digest = packed[SNAPSHOTROW.size:SNAPSHOTROW.size + digestsize]
+        sample = packed[SNAPSHOTROW.size + digestsize:] or None
+        if size == -1:
+            size = mtime_ns = inode = dev = None
+        return (digest, size, mtime_ns, inode, dev, self.algos[algo], sample)
+
+    def get(self, fname):
+        """
+        Get and drop the DB row of a file, None if it has none
+        """
+        if not fname.startswith(self.prefix):
+            return None
+        packed = self.rows.pop(fname[len(self.prefix):], None)
+        return None if packed is None else self.unpack(packed)
+
+    def leftovers(self, errors=()):
+        """
+        Yields (fname, None, filerow) for the rows no get() asked for, i.e.
+        the files gone from the folder, but those below the directories
+        errors (see scantree)
+        """
+        for key, packed in self.rows.items():
+            fname = self.prefix + key
+            if not isunder(fname, errors):
+                yield fname, None, self.unpack(packed)
+
+
+def loadflds():
+    """
+    Write a Python function that can load and parse the configuration file.
+    This function should return the list of folders and list of extensions
+    to exclude for each folder (where applicable).
+    Any further |-separated key=value fields of a line are returned as a
+    dict of options of that folder, e.g.
+    /data/images|.tmp|hash=blake2b:16
+    """
+    flds = []
+    ext = []
+    opts = []
+    #config = getbasefile() + '.ini'
+    config = os.path.join(os.getcwd(), 'filechanges.ini')
+    if os.path.isfile(config):
+        cfile = open(config, 'r')
+        # Parse each config file line and get the folder and extensions
+        for dirline in cfile:
+            # Blank lines are no folder, not the working directory
+            if not dirline.strip():
+                continue
+            fields = dirline.replace('\n', '').split("|")
+            if len(fields) >= 2:
+                extensions = fields[1]
+                entensions = set(extension.strip() for extension
+                                 in extensions.split(","))
+                ext.append(sorted(filter(None, entensions)))
+                flds.append(fields[0].strip())
+            else:
+                flds.append(fields[0].strip())
+                ext.append([])
+            opts.append(parseopts(fields[2:]))
+    return flds, ext, opts
+
+
+def parseopts(fields):
+    """
+    Parse the key=value option fields of a configuration file line
+    """
+    options = {}
+    for field in fields:
+        key, sep, value = field.partition('=')
+        if not sep:
+            raise ValueError('Folder option is not key=value: ' + field)
+        options[key.strip()] = value.strip()
+    # Fail on an unknown algorithm, policy or rule before any folder gets
+    # scanned
+    gethasher(options.get('hash', DEFAULTALGO))
+    if options.get('symlinks', DEFAULTSYMLINKS) not in SYMLINKPOLICIES:
+        raise ValueError('Unknown symlink policy: ' + options['symlinks'])
+    if options.get('shard', SHARDMODES[0]) not in SHARDMODES:
+        raise ValueError('Unknown shard mode: ' + options['shard'])
+    if 'sample' in options:
+        parsesize(options['sample'])
+    if int(options.get('sampleblocks', DEFAULTSAMPLEBLOCKS)) < 0:
+        raise ValueError('sampleblocks can not be negative')
+    if 'blocks' in options and parsesize(options['blocks']) <= 0:
+        raise ValueError('blocks must be a size above 0')
+    if options.get('appends', 'no') not in ('yes', 'no'):
+        raise ValueError('appends is yes or no: ' + options['appends'])
+    FolderRules('', (), options)
+    return options
+
+
+def listsorted(subdir, rules, symlinks, errors, metrics):
+    """
+    Lists a directory for scantree() as (key, isdir, entry, st) sorted by
+    key, st being the stat data of the regular files
+    Directories pruned and files skipped by rules (see FolderRules) are
+    left out.
+    Files come first, by name, then directories by name followed by a path
+    separator: walking the entries in key order visits the directories of
+    a tree in the order of their paths ending with a separator, and the
+    files of each one by name - the (folder, name) order of the DB. A
+    directory that can't be listed is appended to errors. The listing and
+    the stat calls are timed once per directory with metrics.
+    """
+    previous = metrics.switch('walk')
+    followdirs = symlinks == 'follow'
+    keyed = []
+    files = []
+    try:
+        with os.scandir(subdir) as entries:
+            for entry in entries:
+                try:
+                    if symlinks == 'skip' and entry.is_symlink():
+                        continue
+                    isdir = entry.is_dir(follow_symlinks=followdirs)
+                except OSError as e:
+                    print(e)
+                    continue
+                if not isdir:
+                    files.append(entry)
+                elif not rules.prunes(entry.path, entry.name):
+                    keyed.append(((True, entry.name + os.sep), True, entry,
+                                  None))
+    except OSError as e:
+        print(e)
+        if errors is not None:
+            errors.append(subdir)
+    metrics.switch('stat')
+    for entry in files:
+        try:
+            st = entry.stat()
+        except OSError as e:
+            print(e)
+            continue
+        if (stat.S_ISREG(st.st_mode) and
+                not rules.skipfile(entry.name, entry.path, st.st_size)):
+            keyed.append(((False, entry.name), False, entry, st))
+    metrics.switch('walk')
+    metrics.counts['walked'] += len(files)
+    keyed.sort(key=lambda item: item[0])
+    metrics.switch(previous)
+    return iter(keyed)
+
+
+def scantree(folder, rules=None, symlinks=DEFAULTSYMLINKS, errors=None,
+             metrics=None, after=None):
+    """
+    Walks a folder with os.scandir and yields a FileRecord per regular file
+    The entry types come from the directory listing and the stat data of
+    each file is taken once from its DirEntry, so no other stat call is
+    made per file. The directories pruned by rules (see FolderRules, the
+    rules of folder by default) are not descended into and the files it
+    skips are not yielded; folder may be a directory below rules.root.
+    symlinks is one of SYMLINKPOLICIES: 'skip' ignores symbolic
+    links, 'files' follows links to files but not to directories and
+    'follow' follows both (every directory is walked once, so link loops
+    end).
+    Files are yielded in (folder, name) order (see listsorted and
+    splitpath) and only the listings of the directories on the way down
+    are held, so the walk can be merge-joined with the DB rows in constant
+    memory. The directories that couldn't be listed are appended to
+    errors, and the walk is timed with metrics (see ScanMetrics). With
+    after, the directory a resumed scan stopped at (see savecheckpoint),
+    the subtrees that come before it in that order are not listed again;
+    the files of the directories on the way down to it are still yielded.
+    """
+    if symlinks not in SYMLINKPOLICIES:
+        raise ValueError('Unknown symlink policy: ' + symlinks)
+    metrics = metrics or ScanMetrics()
+    rules = rules or FolderRules(folder)
+    followdirs = symlinks == 'follow'
+    visited = set()
+    root = os.path.normpath(folder)
+    if followdirs:
+        try:
+            rootst = os.stat(root)
+            visited.add((rootst.st_dev, rootst.st_ino))
+        except OSError:
+            pass
+    stack = [(root, listsorted(root, rules, symlinks, errors, metrics))]
+    while stack:
+        subdir, entries = stack[-1]
+        item = next(entries, None)
+        if item is None:
+            stack.pop()
+            continue
+        key, isdir, entry, st = item
+        if not isdir:
+            yield FileRecord(entry.name, entry.path, subdir, st)
+            continue
+        if followdirs:
+            try:
+                dirst = entry.stat()
+            except OSError as e:
+                print(e)
+                continue
+            if (dirst.st_dev, dirst.st_ino) in visited:
+                continue
+            visited.add((dirst.st_dev, dirst.st_ino))
+        if (after is not None and
+                prefixrange(os.path.join(entry.path, ''))[1] <= after):
+            continue
+        stack.append((entry.path,
+                      listsorted(entry.path, rules, symlinks, errors, metrics)))
+
+
+def globregex(pattern):
+    """
+    Translates a glob of the include, exclude and prunedirs options into a
+    regular expression matched against paths relative to the folder, with
+    / separators
+    * and ? don't match a /, ** matches across directories and [...] is a
+    character class. A glob without a / matches the last name of a path,
+    at any depth; one with a / is anchored at the folder.
+    """
+    import re
+    anchored = '/' in pattern
+    pattern = pattern.strip('/')
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex.append('[' + chars.replace('\\', '\\\\') + ']')
+            i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return ('' if anchored else '(?:.*/)?') + ''.join(regex)
+
+
+def compileglobs(globs):
+    """
+    Compiles a comma-separated list of globs (see globregex) into one
+    regular expression, None when there is none
+    """
+    patterns = [glob.strip() for glob in (globs or '').split(',')]
+    regexes = [globregex(pattern) for pattern in patterns if pattern]
+    if not regexes:
+        return None
+    import re
+    return re.compile('(?:%s)\\Z' % '|'.join(regexes))
+
+
+def parsesize(value):
+    """
+    Get a number of bytes from a size option, e.g. 512, 64K, 10M or 2G
+    """
+    value = value.strip().upper()
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+class FolderRules:
+    """
+    Which files and directories of a folder are tracked, compiled once
+    from its excluded extensions and its options:
+    include=GLOB,... only the files matching one of the globs are tracked
+    exclude=GLOB,... the files matching one of the globs are not tracked
+    prunedirs=GLOB,... the directories matching one of them are not walked
+    minsize=SIZE, maxsize=SIZE only the files within these sizes are tracked
+    maxdepth=N directories more than N levels below the folder are not walked
+    The extensions are kept in a set, the directory names without a
+    wildcard too, and every kind of glob is matched by a single regular
+    expression (see compileglobs).
+    """
+
+    def __init__(self, folder, exclude=(), options=None):
+        options = options or {}
+        self.root = os.path.normpath(folder)
+        self.prefix = os.path.join(self.root, '')
+        self.exts = frozenset(ext.strip() for ext in exclude if ext.strip())
+        self.include = compileglobs(options.get('include'))
+        self.exclude = compileglobs(options.get('exclude'))
+        prunes = [glob.strip() for glob in
+                  options.get('prunedirs', '').split(',') if glob.strip()]
+        self.prunenames = frozenset(glob for glob in prunes
+                                    if not any(char in glob
+                                               for char in '*?[/'))
+        self.prunedirs = compileglobs(','.join(glob for glob in prunes
+                                               if glob not in self.prunenames))
+        self.minsize = parsesize(options.get('minsize', '0'))
+        self.maxsize = None
+        if 'maxsize' in options:
+            self.maxsize = parsesize(options['maxsize'])
+        self.maxdepth = None
+        if 'maxdepth' in options:
+            self.maxdepth = int(options['maxdepth'])
+
+    def relpath(self, path):
+        """
+        Get the path relative to the folder, with / separators
+        """
+        relpath = path[len(self.prefix):]
+        return relpath if os.sep == '/' else relpath.replace(os.sep, '/')
+
+    def prunes(self, path, name=None):
+        """
+        Checks if a directory below the folder is not to be walked
+        """
+        if (name or os.path.basename(path)) in self.prunenames:
+            return True
+        if self.prunedirs is None and self.maxdepth is None:
+            return False
+        relpath = self.relpath(path)
+        if self.maxdepth is not None and relpath.count('/') >= self.maxdepth:
+            return True
+        return (self.prunedirs is not None and
+                self.prunedirs.match(relpath) is not None)
+
+    def skipfile(self, name, path, size):
+        """
+        Checks if a file of a walked directory is not to be tracked
+        """
+        if self.exts and getfileext(name) in self.exts:
+            return True
+        if size < self.minsize or (self.maxsize is not None and
+                                   size > self.maxsize):
+            return True
+        if self.include is None and self.exclude is None:
+            return False
+        relpath = self.relpath(path)
+        if self.include is not None and self.include.match(relpath) is None:
+            return True
+        return (self.exclude is not None and
+                self.exclude.match(relpath) is not None)
+
+    def walks(self, path):
+        """
+        Checks if a directory below the folder gets walked, i.e. neither it
+        nor any of the directories above it is pruned
+        """
+        subdir = self.root
+        for name in self.relpath(path).split('/'):
+            if not name:
+                continue
+            subdir = os.path.join(subdir, name)
+            if self.prunes(subdir, name):
+                return False
+        return True
+
+    def tracks(self, path, size):
+        """
+        Checks if a file below the folder is tracked
+        """
+        return (self.walks(os.path.dirname(path)) and
+                not self.skipfile(os.path.basename(path), path, size or 0))
+
+
+def isunder(path, dirs):
+    """
+    Checks if path is below one of the directories dirs
+    """
+    return any(path.startswith(subdir + os.sep) for subdir in dirs)
+
+
+def pathrecords(paths, dirs, rules, symlinks=DEFAULTSYMLINKS):
+    """
+    Yields the FileRecord of the regular files among paths and of the
+    files below the directories dirs, that are tracked by rules (see
+    FolderRules)
+    Paths that are gone are skipped and files found below several of the
+    given directories are only yielded once.
+    """
+    topdirs = []
+    for subdir in sorted(dirs):
+        if (not isunder(subdir, topdirs) and os.path.isdir(subdir) and
+                rules.walks(subdir)):
+            topdirs.append(subdir)
+            for record in scantree(subdir, rules, symlinks):
+                yield record
+    for path in sorted(paths):
+        if isunder(path, topdirs):
+            continue
+        try:
+            if symlinks == 'skip' and os.path.islink(path):
+                continue
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            print(e)
+            continue
+        if stat.S_ISREG(st.st_mode) and rules.tracks(path, st.st_size):
+            yield FileRecord(os.path.basename(path), path,
+                             os.path.dirname(path), st)
+
+
+def mergejoin(records, filerows, errors=()):
+    """
+    Joins the FileRecords of a walk with the DB rows of the same folder
+    Both come sorted by (folder, name) (see scantree and dbrows), so one
+    linear pass
+    holding a single item of each side pairs them up. Yields a
+    (path, record, filerow) triple per path: filerow is None for a file
+    that is not in the DB, record is None for a row whose file is gone -
+    unless it is below one of the directories errors, that could not be
+    listed.
+    """
+    filerow = next(filerows, None)
+    for record in records:
+        key = splitpath(record.path)
+        while filerow is not None and filerow[:2] < key:
+            fname = filerow[0] + filerow[1]
+            if not isunder(fname, errors):
+                yield fname, None, filerow[2:]
+            filerow = next(filerows, None)
+        if filerow is not None and filerow[:2] == key:
+            yield record.path, record, filerow[2:]
+            filerow = next(filerows, None)
+        else:
+            yield record.path, record, None
+    while filerow is not None:
+        fname = filerow[0] + filerow[1]
+        if not isunder(fname, errors):
+            yield fname, None, filerow[2:]
+        filerow = next(filerows, None)
+
+
+def lookuppairs(records, lookup):
+    """
+    Yields a (path, record, filerow) triple per FileRecord, its DB row
+    being found through lookup(path)
+    """
+    for record in records:
+        yield record.path, record, lookup(record.path)
+
+
+def gonepairs(conn, paths):
+    """
+    Yields (path, None, filerow) for the DB rows of the paths that no
+    longer exist, and of the files below them
+    """
+    for path in sorted(paths):
+        if os.path.lexists(path):
+            continue
+        filerow = fileindb(conn, path)
+        if filerow is not None:
+            yield path, None, filerow
+        for filerow in dbrows(conn, path):
+            yield filerow[0] + filerow[1], None, filerow[2:]
+
+
+def scanjobs(pairs, rules, rehash=False, options=None, partial=True,
+             blocksof=None):
+    """
+    Yields a (path, record, algos, filerow, sampling, blocking) job for
+    every file that has to be hashed or is gone, out of the (path, record,
+    filerow) pairs of a folder walk (see mergejoin), record being the
+    FileRecord of the file and filerow its DB row (see fileindb). The jobs
+    of gone files have no record, no algos, no sampling and no blocking.
+    The walk only yields the files tracked by rules (see FolderRules);
+    rows of files that are no longer tracked are left alone rather than
+    taken as gone.
+    Files whose size, mtime_ns, inode and dev match the DB are taken as
+    unchanged without being hashed, unless rehash is set. Files are hashed
+    with the algorithm of the folder options (see folderalgo); rows stored
+    with another algorithm are moved over to it the next time their file
+    is looked at.
+    Files of at least the size of the sample option get a sampled
+    fingerprint too (see samplefile): sampling is the (blocks, sample,
+    digest) hashjob() takes, sample and digest being those of the DB row
+    when partial is set and the row has the same size and algorithm -
+    the full digest is then only computed if the samples differ.
+    With the blocks option, blocking is the (prevblocks, prevsize, appends)
+    hashblocks() takes, prevblocks being read through blocksof(path) when
+    the row has the same algorithm; the blocks of a file that grew are
+    only read from where it ended with the appends option and partial.
+    """
+    options = options or {}
+    algo = folderalgo(options)
+    samplesize = parsesize(options['sample']) if 'sample' in options else None
+    blocks = int(options.get('sampleblocks', DEFAULTSAMPLEBLOCKS))
+    appends = options.get('appends') == 'yes' and partial and not rehash
+    for path, record, filerow in pairs:
+        if record is None:
+            if rules.tracks(path, filerow[1]):
+                yield path, None, [], filerow, None, None
+            continue
+        #print('===>', path)
+        samestat = not rehash and statunchanged(filerow, record.stat)
+        algos = [algo]
+        if filerow is not None and rowalgo(filerow) != algo:
+            # Hash with the stored algorithm too, to compare
+            if not samestat:
+                algos.append(rowalgo(filerow))
+        elif samestat:
+            continue
+        sampling = None
+        if samplesize is not None and record.stat.st_size >= samplesize:
+            sampling = (blocks, None, None)
+            if (partial and not rehash and len(algos) == 1 and
+                    filerow is not None and rowalgo(filerow) == algo and
+                    filerow[1] == record.stat.st_size and filerow[6]):
+                sampling = (blocks, filerow[6], filerow[0])
+        blocking = None
+        if blockalgo(algo)[1] is not None:
+            blocking = ((), 0, False)
+            if (filerow is not None and rowalgo(filerow) == algo and
+                    blocksof is not None):
+                blocking = (blocksof(path), filerow[1] or 0, appends)
+        yield path, record, algos, filerow, sampling, blocking
+
+
+def hashjob(origin, algos, sampling=None, blocking=None):
+    """
+    Get the Hashed digests, sample, blocks and tailok of a job, None if
+    the file can't be read
+    With sampling (see scanjobs) the sampled fingerprint of the file is
+    taken first; when it matches the one of the DB row, the digest of the
+    row is returned and the file is not read in full. With blocking the
+    file is hashed by hashblocks(), its digest being their Merkle root.
+    """
+    try:
+        sample = None
+        if sampling is not None:
+            blocks, prevsample, prevdigest = sampling
+            sample = samplefile(origin, blockalgo(algos[0])[0], blocks)
+            if prevsample is not None and sample == prevsample:
+                return Hashed([prevdigest], sample, None, False)
+        if blocking is None:
+            return Hashed(hashdigests(origin, *algos), sample, None, False)
+        blocks, tailok = hashblocks(origin, algos[0], *blocking)
+        digests = [merkleroot(blocks, algos[0])]
+        digests += hashdigests(origin, *algos[1:]) if algos[1:] else []
+        return Hashed(digests, sample, blocks, tailok)
+    except OSError as e:
+        print(e)
+    return None
+
+
+def hashjobs(jobs, pool=None, metrics=None):
+    """
+    Yields (job, hashed) for every job (see scanjobs and hashjob), in the
+    order of the jobs; jobs without algos are not hashed and get no
+    digests.
+    With a pool (see makepool) the files are hashed by its workers while
+    the jobs keep being produced; at most PIPELINEDEPTH of them are queued
+    or being hashed at any time, so a fast walk can't outrun the workers.
+    The hashing, or the wait for the workers, is timed with metrics.
+    """
+    metrics = metrics or ScanMetrics()
+    if pool is None:
+        for job in jobs:
+            hashed = Hashed([], None, None, False)
+            if job[2]:
+                previous = metrics.switch('hash')
+                hashed = hashjob(job[0], job[2], job[4], job[5])
+                metrics.switch(previous)
+            yield job, hashed
+        return
+
+    def result(future):
+        if future is None:
+            return Hashed([], None, None, False)
+        previous = metrics.switch('hash')
+        hashed = future.result()
+        metrics.switch(previous)
+        return hashed
+
+    pending = collections.deque()
+    for job in jobs:
+        future = None
+        if job[2]:
+            future = pool.submit(hashjob, job[0], job[2], job[4], job[5])
+        pending.append((job, future))
+        if len(pending) >= PIPELINEDEPTH:
+            job, future = pending.popleft()
+            yield job, result(future)
+    while pending:
+        job, future = pending.popleft()
+        yield job, result(future)
+
+
+def makepool(workers, processes=False):
+    """
+    Creates the pool of hashing workers of the pipeline mode
+    Threads are used by default since hashlib releases the GIL while it
+    hashes; None is returned when there is a single worker.
+    """
+    if workers <= 1:
+        return None
+    import concurrent.futures
+    if processes:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+
+class ScanMetrics:
+    """
+    Counters and phase timers of a scan pass
+    The time of a pass is split between PHASES: switch() charges the time
+    since the previous switch to the phase that was running, so a phase
+    running inside another one (e.g. the DB reads of a merge-join made
+    while walking) is never counted twice. Only a few perf_counter()
+    calls are made per file.
+    """
+
+    PHASES = ('walk', 'stat', 'hash', 'db', 'report', 'other')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a new pass
+        """
+        self.started = time.time()
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.counts = collections.Counter()
+        self.changes = collections.Counter()
+        self.phase = 'other'
+        self.since = time.perf_counter()
+
+    def switch(self, phase):
+        """
+        Charges the time since the last switch to the running phase, moves
+        on to phase and returns the phase that was running
+        """
+        now = time.perf_counter()
+        self.seconds[self.phase] += now - self.since
+        self.since = now
+        previous, self.phase = self.phase, phase
+        return previous
+
+    def timed(self, iterable, phase, count=None):
+        """
+        Yields the items of iterable, charging the time taken to get each
+        of them to phase; with count, the items are counted under it
+        """
+        items = iter(iterable)
+        while True:
+            previous = self.switch(phase)
+            try:
+                item = next(items)
+            except StopIteration:
+                self.switch(previous)
+                return
+            self.switch(previous)
+            if count is not None:
+                self.counts[count] += 1
+            yield item
+
+    def summary(self):
+        """
+        Get the metrics of the pass as a dict
+        """
+        self.switch(self.phase)
+        return {
+            'started': self.started,
+            'seconds': time.time() - self.started,
+            'phases': dict(self.seconds),
+            'counts': dict(self.counts),
+            'changes': dict(self.changes),
+        }
+
+
+def writeprometheus(summary, fname):
+    """
+    Writes the metrics of a pass (see ScanMetrics.summary) to a Prometheus
+    textfile collector file
+    The file is replaced at once, so it is never read half written.
+    """
+    lines = [
+        '# HELP filechanges_pass_seconds Duration of the last scan pass',
+        '# TYPE filechanges_pass_seconds gauge',
+        'filechanges_pass_seconds %f' % summary['seconds'],
+        '# HELP filechanges_pass_timestamp_seconds Start of the last scan pass',
+        '# TYPE filechanges_pass_timestamp_seconds gauge',
+        'filechanges_pass_timestamp_seconds %f' % summary['started'],
+        '# HELP filechanges_pass_phase_seconds Time of the last scan pass spent in each phase',
+        '# TYPE filechanges_pass_phase_seconds gauge',
+    ]
+    for phase, seconds in summary['phases'].items():
+        lines.append('filechanges_pass_phase_seconds{phase="%s"} %f'
+                     % (phase, seconds))
+    lines += [
+        '# HELP filechanges_pass_total Files and bytes handled by the last scan pass',
+        '# TYPE filechanges_pass_total gauge',
+    ]
+    for name, value in sorted(summary['counts'].items()):
+        lines.append('filechanges_pass_total{kind="%s"} %d' % (name, value))
+    lines += [
+        '# HELP filechanges_pass_changes Changed files found by the last scan pass',
+        '# TYPE filechanges_pass_changes gauge',
+    ]
+    for change, value in sorted(summary['changes'].items()):
+        lines.append('filechanges_pass_changes{change="%s"} %d'
+                     % (change, value))
+    with open(fname + '.tmp', 'w') as open_file:
+        open_file.write('\n'.join(lines) + '\n')
+    os.replace(fname + '.tmp', fname)
+
+
+def exportmetrics(settings):
+    """
+    Exports the metrics of the pass that just ended, to the Prometheus
+    textfile settings.promfile and as one line of JSON appended to
+    settings.jsonfile, when they are set
+    """
+    summary = settings.metrics.summary()
+    try:
+        if settings.promfile:
+            writeprometheus(summary, settings.promfile)
+        if settings.jsonfile:
+            import json
+            with open(settings.jsonfile, 'a') as open_file:
+                open_file.write(json.dumps(summary) + '\n')
+    except OSError as e:
+        print('Export the scan metrics went wrong: ', e)
+    return summary
+
+
+class ScanSettings:
+    """
+    Settings shared by the passes of a scan, mostly from the command line
+    batchsize: rows written per executemany() (--batch)
+    rehash: hash files even when their stat data is unchanged (--paranoid)
+    pool: pool of hashing workers, None to hash in the scan thread
+    (--workers, see makepool)
+    snapshot: prefetch the files rows of each folder (--snapshot)
+    quiet: don't print a line per changed file (--quiet)
+    promfile, jsonfile: where the metrics of every pass are exported
+    (--metrics-prom, --metrics-json, see exportmetrics)
+    shardpool: pool of worker processes the folders are scanned in,
+    None to scan them one after another (--shards, see runshards)
+    spool: connection to the spool a shard worker writes to instead of
+    the DB (see runshard)
+    partial: let matching sampled fingerprints of large files, and the
+    blocks of files appended to, stand for a full hash (see scanjobs);
+    unset on the passes of --fullhash
+    checkpoint: seconds between the checkpoints of a pass, 0 for none
+    (--checkpoint, see savecheckpoint)
+    resume: go on from the checkpoint of an interrupted pass (--resume,
+    see startcheckpoints)
+    """
+
+    def __init__(self, batchsize=BATCHSIZE, rehash=False, pool=None,
+                 snapshot=False, quiet=False, promfile=None, jsonfile=None,
+                 shardpool=None, spool=None, partial=True, checkpoint=0,
+                 resume=False):
+        self.batchsize = batchsize
+        self.rehash = rehash
+        self.pool = pool
+        self.snapshot = snapshot
+        self.quiet = quiet
+        self.promfile = promfile
+        self.jsonfile = jsonfile
+        self.shardpool = shardpool
+        self.spool = spool
+        self.partial = partial
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.metrics = ScanMetrics()
+
+
+def folderpairs(conn, folder, settings, rules, options=None, records=None,
+                gone=(), after=None):
+    """
+    Get the (path, record, filerow) pairs of a folder (see scanjobs)
+    A full walk is merge-joined with the DB rows of the folder, or looked
+    up in a Snapshot of them with settings.snapshot; either way the rows
+    whose file is gone come along. When records is given (see
+    pathrecords) their rows are looked up one by one and only the rows of
+    the paths gone (see gonepairs) are taken as gone. A walk resumed
+    after a directory (see savecheckpoint) only pairs the paths of the
+    directories past it.
+    """
+    options = options or {}
+    metrics = settings.metrics
+    if records is not None:
+        records = metrics.timed(records, 'walk', 'walked')
+
+        def lookup(fname):
+            previous = metrics.switch('db')
+            filerow = fileindb(conn, fname)
+            metrics.switch(previous)
+            return filerow
+
+        return itertools.chain(
+            lookuppairs(records, lookup),
+            metrics.timed(gonepairs(conn, gone), 'db'))
+    errors = []
+    records = scantree(folder, rules, options.get('symlinks', DEFAULTSYMLINKS),
+                       errors, metrics, after)
+    if settings.snapshot:
+        previous = metrics.switch('db')
+        snapshot = Snapshot(conn, folder)
+        metrics.switch(previous)
+        # The leftovers are only read once the walk is over
+        pairs = itertools.chain(lookuppairs(records, snapshot.get),
+                                snapshot.leftovers(errors))
+    else:
+        pairs = mergejoin(records, dbrows(conn, folder, metrics, after),
+                          errors)
+    if after is None:
+        return pairs
+    return (pair for pair in pairs if splitpath(pair[0])[0] > after)
+
+
+def reportchange(report, fname, origin, subdir, change, detail='',
+                 settings=None):
+    """
+    Adds a changed file to the report
+    """
+    settings = settings or ScanSettings()
+    previous = settings.metrics.switch('report')
+    settings.metrics.changes[change] += 1
+    now = getdt("%d-%b-%Y %H_%M_%S")
+    dt = now.split(' ')
+    report.addrow(fname, origin, subdir, dt[0], dt[1], change, detail)
+    if not settings.quiet:
+        print(origin + ' changed now: ' + now)
+    settings.metrics.switch(previous)
+
+
+def checkfilechanges(conn, folder, exclude, report, batch=None,
+                     settings=None, options=None, records=None, gone=(),
+                     root=None, after=None):
+    changed = False
+    """
+    Checks for files changes
+    The files to hash come from scanjobs(), they are hashed by hashjobs()
+    and the results are written to the DB from this thread only. The
+    files of a full walk are paired with their DB rows by folderpairs().
+    New and gone files are only reported once the whole folder was
+    looked at, when pairmoves() tells the renamed ones apart.
+    folder may be a subtree of the configured folder root. With
+    settings.spool the rows and the new and gone files are written to the
+    spool and left to mergespool() to pair.
+    A full walk of a folder with settings.checkpoint commits a checkpoint
+    (see savecheckpoint) each time it moves on to another directory
+    once that many seconds went by since the last one; after is the
+    directory a resumed walk starts past. With settings.snapshot the rows
+    of the gone files only come once the walk is over, out of the walk
+    order, so the only checkpoint is the one of the folder being done
+    (see endcheckpoint).
+    """
+    if batch is None:
+        batch = []
+    settings = settings or ScanSettings()
+    algo = folderalgo(options or {})
+    rules = FolderRules(root or folder, exclude, options)
+    metrics = settings.metrics
+    writer = settings.spool or conn
+    goners = []
+    added = []
+    checkpoint = (settings.checkpoint and settings.spool is None and
+                  records is None and not settings.snapshot)
+    if checkpoint:
+        copied = movemarks(conn)
+        lastdir, checkpointed = None, time.monotonic()
+    pairs = folderpairs(conn, folder, settings, rules, options, records, gone,
+                        after)
+    jobs = scanjobs(pairs, rules, settings.rehash, options, settings.partial,
+                    lambda fname: fileblocks(conn, fname))
+    for job, hashed in hashjobs(jobs, settings.pool, metrics):
+        origin, record, algos, filerow, sampling, blocking = job
+        previous = metrics.switch('db')
+        if checkpoint:
+            subdir = splitpath(origin)[0]
+            if (lastdir is not None and subdir != lastdir and
+                    time.monotonic() - checkpointed >= settings.checkpoint):
+                # The walk is in folder order, so lastdir is done
+                flushbatch(conn, batch)
+                flushmoves(conn, goners, added)
+                report.flush()
+                savecheckpoint(conn, folder, lastdir, copied)
+                checkpointed = time.monotonic()
+            lastdir = subdir
+        if record is None:
+            metrics.counts['gone'] += 1
+            goners.append((origin, filerow[0], filerow[1], rowalgo(filerow)))
+        elif hashed is None:
+            metrics.switch(previous)
+            continue
+        else:
+            sampled = sampling is not None and hashed.sample == sampling[1]
+            filemd5 = hashed.digests[0]
+            prevmd5 = hashed.digests[1] if len(hashed.digests) > 1 else None
+            blocks, appended, detail = None, False, ''
+            if hashed.blocks is not None:
+                prevblocks, prevsize = blocking[:2]
+                first, appended, ranges = blockdiff(
+                    prevblocks, hashed.blocks, blockalgo(algo)[1], prevsize,
+                    record.stat.st_size, hashed.tailok)
+                blocks = list(enumerate(hashed.blocks))[first:]
+                if prevblocks or not prevsize:
+                    detail = rangesdetail(ranges)
+            elif (not sampled and filerow is not None and
+                  blockalgo(algo)[1] is None and
+                  blockalgo(rowalgo(filerow))[1] is not None):
+                # No longer hashed as a Merkle tree, its blocks are dropped
+                blocks = []
+            size = record.stat.st_size
+            if sampled:
+                # The sampled fingerprint vouched for the stored digest
+                metrics.counts['sampled'] += 1
+                metrics.counts['sampled_bytes'] += min(
+                    size, (sampling[0] + 2) * SAMPLEBLOCKSIZE)
+            elif appended and blocking[2]:
+                # Only the blocks from the previous end on were read
+                blocksize = blockalgo(algo)[1]
+                metrics.counts['appended'] += 1
+                metrics.counts['appended_bytes'] += (
+                    size - blocking[1] // blocksize * blocksize)
+            else:
+                metrics.counts['hashed'] += 1
+                metrics.counts['hashed_bytes'] += size
+            #print('File’s md5 hash is:', filemd5, md5indb(conn, origin))
+            # If the file has changed, add it to the report
+            file_changed = comparefile(conn, origin, filemd5, filerow, batch,
+                                       record.stat, algo, prevmd5,
+                                       hashed.sample, blocks, appended)
+            if file_changed == 'IS_SETUP':
+                added.append((origin, filemd5, record.stat.st_size, algo))
+            elif file_changed != 'NOT_CHANGED':
+                changed = True
+                reportchange(report, record.name, origin, record.subdir,
+                             file_changed, detail, settings)
+        if len(batch) >= settings.batchsize:
+            flushbatch(writer, batch)
+        if len(goners) + len(added) >= settings.batchsize:
+            flushmoves(writer, goners, added)
+        metrics.switch(previous)
+    previous = metrics.switch('db')
+    flushmoves(writer, goners, added)
+    metrics.switch(previous)
+    if settings.spool is not None:
+        return changed
+    for file_changed, origin, detail in metrics.timed(pairmoves(conn), 'db'):
+        changed = True
+        reportchange(report, os.path.basename(origin), origin,
+                     os.path.dirname(origin), file_changed, detail, settings)
+    return changed
+
+
+def runfilechanges(conn, report, settings=None):
+    changed = False
+    settings = settings or ScanSettings()
+    settings.metrics.reset()
+    # The rows of the whole pass are written in one transaction, committed
+    # along the way by the checkpoints of --checkpoint
+    batch = []
+    try:
+        if settings.shardpool is not None:
+            changed = runshards(conn, report, settings)
+        else:
+            # Invoke the function that loads and parses the config file
+            currentpaths, bannedextensions, options = loadflds()
+            done, afters = startcheckpoints(conn, currentpaths, settings)
+            for i, fld in enumerate(currentpaths):
+                if fld in done:
+                    # Completed by the interrupted pass that is resumed
+                    continue
+                if fld in afters:
+                    resumemoves(conn, fld)
+                #print('List banned extensions: ', bannedextensions[i], '<--->', fld)
+                # Invoke the function that checks each folder for file changes
+                if checkfilechanges(conn, fld, bannedextensions[i], report,
+                                    batch, settings, options[i],
+                                    after=afters.get(fld)):
+                    changed = True
+                endcheckpoint(conn, fld, batch, report, settings)
+    except BaseException:
+        # An interrupted pass is only kept up to its last checkpoint, in
+        # the DB and in the sqlite report
+        conn.rollback()
+        report.rollback()
+        raise
+    settings.metrics.switch('db')
+    flushbatch(conn, batch)
+    clearcheckpoints(conn)
+    report.flush()
+    conn.commit()
+    exportmetrics(settings)
+    return changed
+
+
+def shardsof(conn, folder, exclude, options):
+    """
+    Get the (folder, paths, gone) shards a configured folder is scanned as
+    by runshards()
+    The folder is a single shard unless its shard option is subdirs: then
+    every directory right below it that gets walked is a shard of its own,
+    and one more shard looks at the files right below it (paths) and
+    takes the directories of the DB right below it that no longer exist
+    as gone.
+    """
+    if options.get('shard', SHARDMODES[0]) == 'folder':
+        return [(folder, None, ())]
+    rules = FolderRules(folder, exclude, options)
+    symlinks = options.get('symlinks', DEFAULTSYMLINKS)
+    shards = []
+    paths = []
+    try:
+        with os.scandir(rules.root) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if symlinks == 'skip' and entry.is_symlink():
+                    continue
+                if not entry.is_dir(follow_symlinks=symlinks == 'follow'):
+                    paths.append(entry.path)
+                elif not rules.prunes(entry.path, entry.name):
+                    shards.append((entry.path, None, ()))
+    except OSError as e:
+        print(e)
+        # A single walk keeps the rows of what it can't list
+        return [(folder, None, ())]
+    topdirs = set()
+    cursor = corecursor(conn, "SELECT path FROM folders WHERE path > ? AND path < ?",
+                        prefixrange(rules.prefix))
+    for (path,) in cursor or ():
+        topdirs.add(path[len(rules.prefix):].split(os.sep, 1)[0])
+    cursor = corecursor(conn, "SELECT name FROM files WHERE folder = (SELECT id FROM folders WHERE path = ?)",
+                        (rules.prefix,))
+    dbfiles = [os.path.join(rules.root, name) for (name,) in cursor or ()]
+    gone = [os.path.join(rules.root, name) for name in sorted(topdirs)]
+    shards.append((rules.root, sorted(set(paths + dbfiles)), gone + dbfiles))
+    return shards
+
+
+def openspool(fname):
+    """
+    Creates the spool file a shard worker writes to (see runshard): the
+    folders and files tables of the rows it stored, the gonefiles and
+    newfiles tables of createmovetables() and the changes table of a
+    SqliteSink
+    Only one process ever writes to it, so it is neither journaled nor
+    synced.
+    """
+    spool = sqlite3.connect(fname, cached_statements=STMTCACHESIZE)
+    spool.execute('PRAGMA journal_mode = OFF')
+    spool.execute('PRAGMA synchronous = OFF')
+    createhashtable(spool)
+    createhashtableidx(spool)
+    createmovetables(spool, temp=False)
+    return spool
+
+
+def runshard(shard):
+    """
+    Scans one shard in a worker process of runshards()
+    shard is a (dbfile, spoolfile, folder, root, exclude, options, params,
+    paths, gone) tuple: folder is the configured folder root or a
+    directory below it, params the keyword arguments of its ScanSettings,
+    and when paths is not None only these paths and the gone ones are
+    looked at (see shardsof). The DB is only read, through a connection
+    of the worker, and everything the scan writes goes to the spool.
+    Returns whether a file changed and the metrics of the shard.
+    """
+    dbfile, spoolfile, folder, root, exclude, options, params, paths, gone = shard
+    conn = connectdb(dbfile)
+    spool = openspool(spoolfile)
+    settings = ScanSettings(spool=spool, **params)
+    report = SqliteSink(spool)
+    batch = []
+    try:
+        records = None
+        if paths is not None:
+            records = pathrecords(paths, (), FolderRules(root, exclude, options),
+                                  options.get('symlinks', DEFAULTSYMLINKS))
+        changed = checkfilechanges(conn, folder, exclude, report, batch,
+                                   settings, options, records, gone, root)
+        settings.metrics.switch('db')
+        flushbatch(spool, batch)
+        report.close()
+        spool.commit()
+    finally:
+        spool.close()
+        conn.close()
+    return changed, settings.metrics.summary()
+
+
+def mergespool(conn, spoolfile, report):
+    """
+    Merges the spool of a shard (see runshard) into the scan pass of conn
+    Its rows are written to the DB, its new and gone files are queued for
+    pairmoves() and its changes are added to the report, BATCHSIZE rows at
+    a time.
+    """
+    spool = sqlite3.connect(spoolfile)
+
+    def withblocks(rows):
+        # The blocks beyond the size of each file are dropped as well
+        query = "SELECT idx, digest FROM blocks WHERE file = ? ORDER BY idx"
+        return [row[:8] + (spool.execute(query, (row[8],)).fetchall(),)
+                for row in rows]
+
+    queries = [
+        ("SELECT d.path || f.name, f.digest, f.size, f.mtime_ns, f.inode, "
+         "f.dev, f.algo, f.sample, f.id FROM files f JOIN folders d ON "
+         "d.id = f.folder",
+         lambda rows: writerows(conn, withblocks(rows))),
+        ("SELECT fname, md5, size, algo FROM gonefiles",
+         lambda rows: flushmoves(conn, rows, [])),
+        ("SELECT fname, md5, size, algo FROM newfiles ORDER BY rowid",
+         lambda rows: flushmoves(conn, [], rows)),
+        ("SELECT fname, fullname, folder, date, time, change, detail "
+         "FROM changes ORDER BY id",
+         lambda rows: [report.addrow(*row) for row in rows]),
+    ]
+    try:
+        for query, merge in queries:
+            cursor = spool.execute(query)
+            for rows in iter(lambda: cursor.fetchmany(BATCHSIZE), []):
+                merge(rows)
+    except Error as e:
+        print("Query execution error: ", e)
+    finally:
+        spool.close()
+
+
+def runshards(conn, report, settings):
+    """
+    Runs the folders of a scan pass, or the shards they are split into
+    (see shardsof), in the worker processes of settings.shardpool
+    Every worker reads the DB through a connection of its own and writes
+    to a spool file of its own, so the workers never wait on each other
+    for the SQLite write lock. The spools are merged in the order of the
+    shards within the transaction of the pass, and the new and gone files
+    of all the shards of a folder are paired together, so a file moved
+    from one shard to another is still reported as renamed. The phase
+    times of the workers add up to those of the pass.
+    """
+    changed = False
+    metrics = settings.metrics
+    dbfile = conn.execute('PRAGMA database_list').fetchone()[2]
+    params = {'batchsize': settings.batchsize, 'rehash': settings.rehash,
+              'snapshot': settings.snapshot, 'quiet': settings.quiet,
+              'partial': settings.partial}
+    import shutil
+    import tempfile
+    currentpaths, bannedextensions, options = loadflds()
+    spooldir = tempfile.mkdtemp(prefix='filechanges-')
+    futures = []
+    try:
+        shards = []
+        # Index of the last shard of each folder
+        lasts = set()
+        for i, fld in enumerate(currentpaths):
+            for folder, paths, gone in shardsof(conn, fld, bannedextensions[i],
+                                                options[i]):
+                spoolfile = os.path.join(spooldir, 'shard%d.db' % len(shards))
+                shards.append((dbfile, spoolfile, folder, fld,
+                               bannedextensions[i], options[i], params,
+                               paths, gone))
+            lasts.add(len(shards) - 1)
+        futures = [settings.shardpool.submit(runshard, shard)
+                   for shard in shards]
+        for n, (shard, future) in enumerate(zip(shards, futures)):
+            shardchanged, summary = future.result()
+            changed = changed or shardchanged
+            for phase, seconds in summary['phases'].items():
+                metrics.seconds[phase] += seconds
+            metrics.counts.update(summary['counts'])
+            metrics.changes.update(summary['changes'])
+            previous = metrics.switch('db')
+            mergespool(conn, shard[1], report)
+            metrics.switch(previous)
+            if n not in lasts:
+                continue
+            for file_changed, origin, detail in metrics.timed(
+                    pairmoves(conn), 'db'):
+                changed = True
+                reportchange(report, os.path.basename(origin), origin,
+                             os.path.dirname(origin), file_changed, detail,
+                             settings)
+    finally:
+        for future in futures:
+            future.cancel()
+        shutil.rmtree(spooldir, ignore_errors=True)
+    return changed
+
+
+def checkwatchedpaths(conn, report, files, dirs, settings=None):
+    """
+    Checks the files and directories reported by fswatch.Watcher.collect()
+    Their tags are the indexes of the folders of the config file. The DB
+    rows of those that no longer exist are taken as gone.
+    """
+    changed = False
+    settings = settings or ScanSettings()
+    settings.metrics.reset()
+    batch = []
+    currentpaths, bannedextensions, options = loadflds()
+    try:
+        for i, fld in enumerate(currentpaths):
+            folderfiles = [path for tag, path in files if tag == i]
+            folderdirs = [path for tag, path in dirs if tag == i]
+            if not folderfiles and not folderdirs:
+                continue
+            rules = FolderRules(fld, bannedextensions[i], options[i])
+            records = pathrecords(folderfiles, folderdirs, rules,
+                                  options[i].get('symlinks', DEFAULTSYMLINKS))
+            if checkfilechanges(conn, fld, bannedextensions[i], report, batch,
+                                settings, options[i], records,
+                                folderfiles + folderdirs):
+                changed = True
+    except BaseException:
+        # The next start of --watch scans everything again
+        conn.rollback()
+        report.rollback()
+        raise
+    settings.metrics.switch('db')
+    flushbatch(conn, batch)
+    report.flush()
+    conn.commit()
+    exportmetrics(settings)
+    return changed
+
+
+def watchfilechanges(conn, report, settings=None, interval=WATCHINTERVAL):
+    """
+    Keeps the DB up to date from inotify events, until interrupted
+    Every folder of the config file is watched and then scanned in full
+    once. After that only the files and new directories touched are
+    looked at, once each burst of events has settled. A full scan is run
+    again when the kernel event queue overflowed; without inotify, or once
+    the watch limit is reached, a full scan runs every interval seconds.
+    """
+    import fswatch
+    watcher = None
+    if fswatch.available():
+        watcher = fswatch.Watcher()
+        currentpaths, bannedextensions, options = loadflds()
+        try:
+            for i, fld in enumerate(currentpaths):
+                rules = FolderRules(fld, bannedextensions[i], options[i])
+                watcher.addtree(fld, i, rules.prunes)
+        except fswatch.WatchLimitError as e:
+            print(e, '- falling back to periodic full scans')
+            watcher.close()
+            watcher = None
+    else:
+        print('inotify is not available - falling back to periodic full scans')
+    try:
+        runfilechanges(conn, report, settings)
+        while True:
+            report.rotate()
+            if watcher is None:
+                time.sleep(interval)
+                runfilechanges(conn, report, settings)
+                continue
+            try:
+                # Wake up every interval seconds for the report rotation
+                files, dirs, overflow = watcher.collect(interval)
+            except fswatch.WatchLimitError as e:
+                print(e, '- falling back to periodic full scans')
+                watcher.close()
+                watcher = None
+                overflow = True
+            if overflow:
+                # Events were lost, only a full scan can catch up
+                runfilechanges(conn, report, settings)
+            else:
+                checkwatchedpaths(conn, report, files, dirs, settings)
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+def getdt(frmt):
+    today = datetime.today()
+    return today.strftime(frmt)
+
+
+class ReportSink:
+    """
+    Where the changed files found by a scan are reported
+    A sink gets one addrow() call per changed file and is then either
+    closed, which returns the name of what it wrote, or discarded. Sinks
+    writing a file name it REPORT_from_<start>_to_<end> plus their EXT.
+    """
+
+    HEADER = ("File Name", "Full File Name", "Folder Name", "Date", "Time",
+              "Change", "Detail")
+    EXT = None
+
+    def __init__(self, st=None):
+        self.st = st or getdt("%d-%b-%Y %H_%M_%S")
+
+    def addrow(self, fn, ffn, fld, d, t, change, detail=''):
+        """
+        Reports a changed file, detail being the former name of a renamed
+        one
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Finalize the creation of the report and return its name
+        """
+        raise NotImplementedError
+
+    def discard(self):
+        """
+        Drops the report without writing it
+        """
+
+    def flush(self):
+        """
+        Hands the rows added so far over to the file or the DB, at the
+        checkpoints of a scan (see savecheckpoint)
+        """
+
+    def rollback(self):
+        """
+        Drops the rows added since the last flush() that are not written
+        yet, when the scan pass that found them is rolled back
+        """
+
+    def reportname(self):
+        """
+        Get the file name of the report, not taken yet
+        """
+        dt = "_from_" + self.st + "_to_" + getdt("%d-%b-%Y %H_%M_%S")
+        return reportname(f"REPORT{dt}", self.EXT)
+
+
+class XlsxSink(ReportSink):
+    """
+    Excel report of the changed files
+    The workbook is in openpyxl's write-only mode: rows are streamed to a
+    temporary file as they are added instead of being kept in memory, and
+    the next free row is tracked by a cursor instead of being looked up.
+    openpyxl is only imported once the report gets its first row: a
+    report closed without any is written by saveempty(), so runs that find
+    no change never load it.
+    """
+
+    EXT = ".xlsx"
+
+    def __init__(self, st=None):
+        super().__init__(st)
+        self.wb = None
+        self.ws = None
+        self.row = 1
+
+    def start(self):
+        """
+        Creates the workbook and its header row
+        """
+        import socket
+        from openpyxl import Workbook
+        # Create the workbook, get the hostname and current DateTime
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet(socket.gethostname())
+        self.header()
+
+    def header(self):
+        from openpyxl.styles import Font
+        from openpyxl.cell import WriteOnlyCell
+        ft = Font(color="000000", bold=True)
+        cells = []
+        for title in self.HEADER:
+            cell = WriteOnlyCell(self.ws, value=title)
+            cell.font = ft
+            cells.append(cell)
+        self.ws.append(cells)
+        self.row += 1
+
+    def addrow(self, fn, ffn, fld, d, t, change, detail=''):
+        """
+        Appends a changed file to the report and returns its row number
+        """
+        if self.wb is None:
+            self.start()
+        self.ws.append([fn, ffn, fld, d, t, change, detail])
+        self.row += 1
+        return self.row - 1
+
+    def close(self):
+        fname = self.reportname()
+        if self.wb is None:
+            self.saveempty(fname)
+        else:
+            self.wb.save(fname)
+        return fname
+
+    def saveempty(self, fname):
+        """
+        Writes a workbook with only the header row, as a bare SpreadsheetML
+        package through zipfile rather than openpyxl
+        """
+        import socket
+        import zipfile
+
+        def escape(text):
+            return (text.replace('&', '&amp;').replace('<', '&lt;')
+                    .replace('>', '&gt;').replace('"', '&quot;'))
+        ns = 'http://schemas.openxmlformats.org/'
+        rels = ns + 'officeDocument/2006/relationships'
+        cells = ''.join('<c t="inlineStr" s="1"><is><t>%s</t></is></c>'
+                        % escape(title) for title in self.HEADER)
+        parts = {
+            '[Content_Types].xml':
+                '<Types xmlns="%spackage/2006/content-types">'
+                '<Default Extension="rels" ContentType="application/'
+                'vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="xml" ContentType="application/xml"/>'
+                '<Override PartName="/xl/workbook.xml" ContentType="'
+                'application/vnd.openxmlformats-officedocument.spreadsheetml.'
+                'sheet.main+xml"/><Override PartName="/xl/worksheets/'
+                'sheet1.xml" ContentType="application/vnd.openxmlformats-'
+                'officedocument.spreadsheetml.worksheet+xml"/><Override '
+                'PartName="/xl/styles.xml" ContentType="application/'
+                'vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"'
+                '/></Types>' % ns,
+            '_rels/.rels':
+                '<Relationships xmlns="%spackage/2006/relationships">'
+                '<Relationship Id="rId1" Type="%s/officeDocument" '
+                'Target="xl/workbook.xml"/></Relationships>' % (ns, rels),
+            'xl/workbook.xml':
+                '<workbook xmlns="%sspreadsheetml/2006/main" xmlns:r="%s">'
+                '<sheets><sheet name="%s" sheetId="1" r:id="rId1"/></sheets>'
+                '</workbook>' % (ns, rels, escape(socket.gethostname()[:31])),
+            'xl/_rels/workbook.xml.rels':
+                '<Relationships xmlns="%spackage/2006/relationships">'
+                '<Relationship Id="rId1" Type="%s/worksheet" '
+                'Target="worksheets/sheet1.xml"/><Relationship Id="rId2" '
+                'Type="%s/styles" Target="styles.xml"/></Relationships>'
+                % (ns, rels, rels),
+            'xl/styles.xml':
+                '<styleSheet xmlns="%sspreadsheetml/2006/main"><fonts '
+                'count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+                '<font><b/><sz val="11"/><color rgb="FF000000"/><name '
+                'val="Calibri"/></font></fonts><fills count="1"><fill>'
+                '<patternFill patternType="none"/></fill></fills><borders '
+                'count="1"><border/></borders><cellStyleXfs count="1"><xf '
+                'fontId="0"/></cellStyleXfs><cellXfs count="2"><xf '
+                'fontId="0" xfId="0"/><xf fontId="1" xfId="0" applyFont="1"/>'
+                '</cellXfs><cellStyles count="1"><cellStyle name="Normal" '
+                'xfId="0" builtinId="0"/></cellStyles></styleSheet>' % ns,
+            'xl/worksheets/sheet1.xml':
+                '<worksheet xmlns="%sspreadsheetml/2006/main"><sheetData>'
+                '<row r="1">%s</row></sheetData></worksheet>' % (ns, cells),
+        }
+        with zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, xml in parts.items():
+                archive.writestr(name, '<?xml version="1.0" encoding="UTF-8" '
+                                 'standalone="yes"?>\n' + xml)
+
+    def discard(self):
+        if self.ws is not None:
+            self.ws.close()
+
+
+class FileSink(ReportSink):
+    """
+    Report streamed to a text file through a large write buffer
+    The file is written as REPORT_from_<start><EXT>.part and renamed to
+    its final name when the report is closed.
+    """
+
+    def __init__(self, st=None):
+        super().__init__(st)
+        self.partname = reportname("REPORT_from_" + self.st, self.EXT + ".part")
+        self.file = open(self.partname, 'w', newline='', encoding='utf-8',
+                         buffering=SINKBUFFERSIZE)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        fname = self.reportname()
+        os.replace(self.partname, fname)
+        return fname
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.partname)
+
+
+class CsvSink(FileSink):
+    """
+    CSV report of the changed files
+    """
+
+    EXT = ".csv"
+
+    def __init__(self, st=None):
+        import csv
+        super().__init__(st)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.HEADER)
+
+    def addrow(self, fn, ffn, fld, d, t, change, detail=''):
+        self.writer.writerow((fn, ffn, fld, d, t, change, detail))
+
+
+class JsonlSink(FileSink):
+    """
+    JSON Lines report of the changed files, one object per changed file
+    """
+
+    EXT = ".jsonl"
+    KEYS = ("file", "path", "folder", "date", "time", "change", "detail")
+
+    def __init__(self, st=None):
+        import json
+        super().__init__(st)
+        self.dumps = json.dumps
+
+    def addrow(self, fn, ffn, fld, d, t, change, detail=''):
+        values = (fn, ffn, fld, d, t, change, detail)
+        self.file.write(self.dumps(dict(zip(self.KEYS, values))))
+        self.file.write('\n')
+
+
+class SqliteSink(ReportSink):
+    """
+    Report of the changed files kept in the changes table of the SQLite DB
+    Rows are inserted BATCHSIZE at a time through the scan connection, so
+    they are committed along with the scan pass that found them. Closing a
+    segment (see RotatingReport) only inserts the rows left and never
+    commits: that is up to the pass and its checkpoints.
+    """
+
+    def __init__(self, conn, st=None):
+        super().__init__(st)
+        self.conn = conn
+        self.rows = []
+        query = ("CREATE TABLE IF NOT EXISTS changes (id INTEGER PRIMARY KEY, "
+                 "fname TEXT, fullname TEXT NOT NULL, folder TEXT, "
+                 "date TEXT, time TEXT, change TEXT, detail TEXT)")
+        conn.execute(query)
+        cols = [row[1] for row in conn.execute('PRAGMA table_info(changes)')]
+        if 'detail' not in cols:
+            conn.execute('ALTER TABLE changes ADD COLUMN detail TEXT')
+
+    def addrow(self, fn, ffn, fld, d, t, change, detail=''):
+        self.rows.append((fn, ffn, fld, d, t, change, detail))
+        if len(self.rows) >= BATCHSIZE:
+            self.flush()
+
+    def flush(self):
+        query = ("INSERT INTO changes (fname, fullname, folder, date, time, "
+                 "change, detail) VALUES (?,?,?,?,?,?,?)")
+        try:
+            self.conn.executemany(query, self.rows)
+        except Error as e:
+            print("Query execution error: ", e)
+        del self.rows[:]
+
+    def rollback(self):
+        del self.rows[:]
+
+    def close(self):
+        self.flush()
+        return 'changes'
+
+    def discard(self):
+        self.close()
+
+
+def reportname(base, ext):
+    """
+    Get a report file name that is not taken yet
+    Reports rolled over within the same second get a _2, _3... suffix.
+    """
+    fname = base + ext
+    count = 1
+    while os.path.exists(fname):
+        count += 1
+        fname = "%s_%d%s" % (base, count, ext)
+    return fname
+
+
+# Report sinks selectable with --report
+REPORTSINKS = {
+    'xlsx': XlsxSink,
+    'csv': CsvSink,
+    'jsonl': JsonlSink,
+    'sqlite': SqliteSink,
+}
+
+
+def makesink(kind, conn=None):
+    """
+    Get a function making report sinks of a kind of REPORTSINKS
+    """
+    if kind not in REPORTSINKS:
+        raise ValueError('Unknown report sink: ' + kind)
+    if kind == 'sqlite':
+        return lambda st=None: SqliteSink(conn, st)
+    return REPORTSINKS[kind]
+
+
+class RotatingReport:
+    """
+    Report split into segments rolled over by row count, age or size
+    Every segment is a report sink of its own, made by newreport(), that is
+    closed - i.e. written to disk - as soon as it reaches maxrows rows,
+    maxsecs seconds of age or about maxbytes bytes of cell text, so a
+    long-running scan keeps a flat memory footprint and a crash only loses
+    the current segment. A limit of 0 is not enforced. Segments without
+    rows are not rolled over, and the last one is only written when it
+    has rows or is the only one.
+    """
+
+    def __init__(self, newreport, maxrows=0, maxsecs=0, maxbytes=0):
+        self.newreport = newreport
+        self.maxrows = maxrows
+        self.maxsecs = maxsecs
+        self.maxbytes = maxbytes
+        self.written = 0
+        self.start()
+
+    def start(self):
+        self.current = self.newreport()
+        self.started = time.monotonic()
+        self.rows = 0
+        self.bytes = 0
+
+    def addrow(self, *values):
+        """
+        Appends a changed file to the current segment
+        """
+        row = self.current.addrow(*values)
+        self.rows += 1
+        self.bytes += sum(len(str(value)) for value in values)
+        self.rotate()
+        return row
+
+    def isfull(self):
+        """
+        Checks if the current segment reached one of the limits
+        """
+        return ((self.maxrows and self.rows >= self.maxrows) or
+                (self.maxsecs and
+                 time.monotonic() - self.started >= self.maxsecs) or
+                (self.maxbytes and self.bytes >= self.maxbytes))
+
+    def rotate(self):
+        """
+        Closes the current segment and starts the next one if it is full
+        Called after every row and at the end of each scan pass, for the
+        age limit.
+        """
+        if self.rows and self.isfull():
+            fname = self.current.close()
+            self.written += 1
+            self.start()
+            return fname
+        return None
+
+    def flush(self):
+        """
+        Flushes the current segment (see ReportSink.flush)
+        """
+        self.current.flush()
+
+    def rollback(self):
+        """
+        Rolls the current segment back (see ReportSink.rollback)
+        """
+        self.current.rollback()
+
+    def close(self):
+        """
+        Closes the current segment
+        """
+        if self.rows or not self.written:
+            self.written += 1
+            return self.current.close()
+        self.current.discard()
+        return None
+
+
+class HistoryLog:
+    """
+    Report that also appends every changed file to the history table
+    The rows added to report are queued, with the time they were found,
+    and written to history by flush(), which the scan calls right before
+    it commits a pass or a checkpoint, so history holds the changes of the
+    committed passes only. The rows of an interrupted pass are dropped when
+    it is rolled back or closed.
+    """
+
+    def __init__(self, report, conn):
+        self.report = report
+        self.conn = conn
+        self.rows = []
+
+    def addrow(self, fn, ffn, fld, d, t, change, detail=''):
+        self.rows.append((time.time(), ffn, change, detail))
+        return self.report.addrow(fn, ffn, fld, d, t, change, detail)
+
+    def rotate(self):
+        return self.report.rotate()
+
+    def flush(self):
+        try:
+            writehistory(self.conn, self.rows)
+        except Error as e:
+            print("Query execution error: ", e)
+        del self.rows[:]
+        self.report.flush()
+
+    def rollback(self):
+        del self.rows[:]
+        self.report.rollback()
+
+    def close(self):
+        del self.rows[:]
+        return self.report.close()
+
+
+def getarg(args, name, default=None):
+    """
+    Get the value of a --name=value command line argument
+    """
+    prefix = name + '='
+    for arg in args:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+
+def printrollup(conn, path):
+    """
+    Prints the rollup of a directory from the DB, without scanning: it
+    changes whenever anything below the directory changes
+    """
+    rollup, count = dirrollup(conn, path)
+    if rollup is None:
+        print('No file recorded below ' + path)
+    else:
+        print(rollup.hex(), count, os.path.join(path, ''))
+
+
+def parsetime(value):
+    """
+    Get the stamp of a time given on the command line, as seconds since
+    the epoch or as an ISO 8601 date or date and time (local time)
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def printhistory(conn, path, since=None, until=None):
+    """
+    Prints the changes found below path from since to until (see
+    historyrows), one per line, and how many there were
+    """
+    count = 0
+    for stamp, change, fname, detail in historyrows(conn, path, since, until):
+        when = datetime.fromtimestamp(stamp).strftime('%Y-%m-%d %H:%M:%S')
+        print('\t'.join((when, change, fname) + ((detail,) if detail else ())))
+        count += 1
+    print('%d changes' % count)
+
+
+def printduplicates(conn, path=None, minsize=1):
+    """
+    Prints the groups of files of the same content below path, those
+    that free the most bytes first, the bytes each group frees once only
+    one of its files is kept, and the totals
+    Hard links to the same file are printed on one line.
+    """
+    counts = {'prefixes': 0, 'hashed': 0, 'bytes': 0}
+    groups = sorted(duplicategroups(conn, path, minsize, counts),
+                    key=lambda item: (-item[0] * (len(item[1]) - 1), item[1]))
+    reclaimable = 0
+    for size, group in groups:
+        freed = size * (len(group) - 1)
+        reclaimable += freed
+        print('%d files of %d bytes, %d bytes reclaimable' %
+              (len(group), size, freed))
+        for links in group:
+            print('\t' + ' = '.join(links))
+    print('%d groups, %d bytes reclaimable, %d prefixes and %d files hashed '
+          '(%d bytes read)' % (len(groups), reclaimable, counts['prefixes'],
+                               counts['hashed'], counts['bytes']))
+
+
+def execute(args):
+    # --rollup=PATH only prints the rollup of a directory as last scanned
+    rollup = getarg(args, '--rollup')
+    if rollup is not None:
+        conn = connectdb()
+        printrollup(conn, rollup)
+        conn.close()
+        return
+    # --history=PATH only prints the changes found below PATH, between
+    # --since=T1 and --until=T2
+    history = getarg(args, '--history')
+    if history is not None:
+        conn = connectdb()
+        since, until = getarg(args, '--since'), getarg(args, '--until')
+        printhistory(conn, history, since and parsetime(since),
+                     until and parsetime(until))
+        conn.close()
+        return
+    # --history-prune only applies the retention policy of the history:
+    # rows older than --history-days=N are deleted, and those older than
+    # --history-compact=N compacted to a change per file and day
+    if '--history-prune' in args:
+        conn = connectdb()
+        deleted = prunehistory(conn, float(getarg(args, '--history-days', 0)),
+                               float(getarg(args, '--history-compact', 0)))
+        print('%d history rows deleted' % deleted)
+        conn.close()
+        return
+    # --duplicates[=PATH] only prints the groups of files of the same
+    # content (below PATH), of at least --min-size=B bytes
+    duplicates = getarg(args, '--duplicates')
+    if duplicates is not None or '--duplicates' in args:
+        conn = connectdb()
+        printduplicates(conn, duplicates,
+                        parsesize(getarg(args, '--min-size', '1')))
+        conn.close()
+        return
+    settings = ScanSettings(
+        int(getarg(args, '--batch', BATCHSIZE)),
+        pool=makepool(int(getarg(args, '--workers', 1)), '--processes' in args),
+        snapshot='--snapshot' in args, quiet='--quiet' in args,
+        promfile=getarg(args, '--metrics-prom'),
+        jsonfile=getarg(args, '--metrics-json'),
+        checkpoint=float(getarg(args, '--checkpoint', CHECKPOINTSECS)),
+        resume='--resume' in args)
+    # Folders, or shards of them, are scanned by --shards=N processes
+    shards = int(getarg(args, '--shards', 1))
+    if shards > 1:
+        import concurrent.futures
+        settings.shardpool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=shards)
+    # The whole run is profiled into --profile=FILE (see pstats)
+    profile = getarg(args, '--profile')
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    # Every Nth pass rehashes all files even if their stat data is unchanged
+    paranoid = int(getarg(args, '--paranoid', 0))
+    # Every Nth pass fully hashes large files whose sample still matches,
+    # and files appended to
+    fullhash = int(getarg(args, '--fullhash', 0))
+    passes = 0
+    interval = float(getarg(args, '--interval', WATCHINTERVAL))
+    # One DB connection is shared by every pass of the scan
+    conn = connectdb()
+    # Start the creation of the report (--report=xlsx by default), rolled
+    # over into segments by --rotate-rows, --rotate-secs or --rotate-bytes,
+    # every change being kept in the history table as well
+    report = HistoryLog(
+        RotatingReport(makesink(getarg(args, '--report', 'xlsx'), conn),
+                       int(getarg(args, '--rotate-rows', 0)),
+                       float(getarg(args, '--rotate-secs', 0)),
+                       int(getarg(args, '--rotate-bytes', 0))), conn)
+    try:
+        if '--watch' in args:
+            try:
+                watchfilechanges(conn, report, settings,
+                                 interval or WATCHINTERVAL)
+            except KeyboardInterrupt:
+                # Check for a keyboard interruption to stop the script
+                print('Program stopped!!')
+        elif '--loop' in args:
+            try:
+                while True:
+                    passes += 1
+                    settings.rehash = paranoid > 0 and passes % paranoid == 0
+                    settings.partial = not (fullhash > 0 and
+                                            passes % fullhash == 0)
+                    changed = runfilechanges(conn, report, settings)
+                    report.rotate()
+                    time.sleep(interval)
+            except KeyboardInterrupt:
+                # Check for a keyboard interruption to stop the script
+                print('Program stopped!!')
+                pass
+        else:
+            settings.rehash = paranoid == 1
+            settings.partial = fullhash != 1
+            changed = runfilechanges(conn, report, settings)
+    finally:
+        # Finalize the creation of the report, even after a crash
+        report.close()
+        conn.close()
+        if settings.pool is not None:
+            settings.pool.shutdown()
+        if settings.shardpool is not None:
+            settings.shardpool.shutdown()
+        if profile:
+            profiler.disable()
+            profiler.dump_stats(profile)
 
 
 """Check functionality"""
@@ -0,0 +1,209 @@
+import os
+import sys
+import errno
+import select
+import struct
+import time
+import ctypes
+import ctypes.util
+
+
+# inotify event flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Events a watched directory subscribes to
+WATCHMASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+             IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+             IN_MOVE_SELF | IN_ONLYDIR)
+# Header of a struct inotify_event: wd, mask, cookie, len
+EVENTHEADER = struct.Struct('iIII')
+# Bytes read from the inotify file descriptor at once
+READSIZE = 64 * 1024
+# Seconds without a new event after which a burst of events is handed over
+DEBOUNCE = 0.2
+# Longest a burst of events is held back, in seconds
+MAXDELAY = 1.0
+
+
+class WatchLimitError(Exception):
+    """
+    Raised when no more inotify watches can be added (fs.inotify.max_user_watches)
+    """
+
+
+def available():
+    """
+    Checks if inotify can be used on this platform
+    """
+    return sys.platform.startswith('linux') and getlibc() is not None
+
+
+def getlibc():
+    """
+    Loads the C library the inotify calls are made through
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class Watcher:
+    """
+    Watches directory trees through inotify and collects the paths touched
+    Every watched directory carries a tag (e.g. the index of the configured
+    folder it belongs to) that is handed back with its events.
+    """
+
+    def __init__(self):
+        self.libc = getlibc()
+        if self.libc is None or not sys.platform.startswith('linux'):
+            raise OSError('inotify is not available on this platform')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.dirs = {}
+        self.prunes = {}
+
+    def close(self):
+        """
+        Closes the inotify file descriptor, dropping all its watches
+        """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.dirs.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def adddir(self, path, tag):
+        """
+        Adds a watch on one directory
+        Raises WatchLimitError when the inotify watch limit is reached.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         WATCHMASK | IN_DONT_FOLLOW)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise WatchLimitError('inotify watch limit reached at ' + path)
+            raise OSError(err, os.strerror(err), path)
+        self.dirs[wd] = (path, tag)
+        return wd
+
+    def addtree(self, folder, tag, prune=None):
+        """
+        Adds watches on a directory and every directory below it
+        Directories for which prune(path) is true are not watched, here and
+        when they get created later on below a directory tagged with tag.
+        """
+        self.prunes[tag] = prune
+        stack = [os.path.normpath(folder)]
+        while stack:
+            subdir = stack.pop()
+            try:
+                self.adddir(subdir, tag)
+                with os.scandir(subdir) as entries:
+                    for entry in entries:
+                        if (entry.is_dir(follow_symlinks=False) and
+                                not (prune and prune(entry.path))):
+                            stack.append(entry.path)
+            except FileNotFoundError:
+                # Removed while it was being watched
+                pass
+            except WatchLimitError:
+                raise
+            except OSError as e:
+                print(e)
+
+    def readevents(self):
+        """
+        Reads the pending events and yields (wd, mask, name) for each
+        """
+        while True:
+            try:
+                data = os.read(self.fd, READSIZE)
+            except BlockingIOError:
+                return
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, namelen = EVENTHEADER.unpack_from(data, pos)
+                pos += EVENTHEADER.size
+                name = data[pos:pos + namelen].rstrip(b'\0')
+                pos += namelen
+                yield wd, mask, os.fsdecode(name)
+
+    def collect(self, timeout=None):
+        """
+        Waits for events and returns the paths they touched
+        Blocks until a first event arrives (or timeout seconds, None waits
+        forever), then keeps reading until no event came for DEBOUNCE
+        seconds or MAXDELAY seconds went by. The events are coalesced into
+        a (files, dirs, overflow) tuple: files is a set of (tag, path) of
+        the files touched, dirs a set of (tag, path) of the directories
+        created, moved or deleted, whose whole subtree has to be looked at
+        (new ones get watched here unless they are pruned), and overflow
+        tells that the kernel queue overflowed so events were lost.
+        """
+        files = set()
+        dirs = set()
+        overflow = False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return files, dirs, overflow
+        start = time.monotonic()
+        while True:
+            for wd, mask, name in self.readevents():
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                    continue
+                if wd not in self.dirs:
+                    continue
+                subdir, tag = self.dirs[wd]
+                if not name:
+                    # IN_DELETE_SELF, IN_MOVE_SELF or events on the
+                    # watched directory itself
+                    continue
+                path = os.path.join(subdir, name)
+                prune = self.prunes.get(tag)
+                if mask & IN_ISDIR:
+                    if (mask & (IN_CREATE | IN_MOVED_TO) and
+                            not (prune and prune(path))):
+                        self.addtree(path, tag, prune)
+                        dirs.add((tag, path))
+                    elif mask & (IN_MOVED_FROM | IN_DELETE):
+                        dirs.add((tag, path))
+                else:
+                    files.add((tag, path))
+            left = min(DEBOUNCE, start + MAXDELAY - time.monotonic())
+            if left <= 0 or not select.select([self.fd], [], [], left)[0]:
+                break
+        return files, dirs, overflow
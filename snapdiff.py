@@ -0,0 +1,111 @@
+"""
+Compares two snapshots of the filechanges DB, e.g. copies of filechanges.db
+kept from two scans or taken on two machines, through the rollups of their
+dirs table: only the directories whose rollups differ are looked into, so
+unchanged subtrees cost one lookup each whatever their size.
+
+Usage: python snapdiff.py LEFT.db RIGHT.db --path=PATH [--other-path=PATH]
+  --path=PATH        directory compared, as recorded in LEFT.db
+  --other-path=PATH  the same directory as recorded in RIGHT.db, when it
+                     was scanned under another path (default: PATH)
+Every difference is printed as one CHANGED, ONLY_LEFT or ONLY_RIGHT line
+with its path relative to PATH, directories ending with a path separator.
+The exit status is 0 when both trees are the same, 1 when they differ and
+2 on errors.
+"""
+import os
+import sys
+import pathlib
+import sqlite3
+
+import filechanges
+
+from sqlite3 import Error
+
+
+def opensnapshot(dbfile):
+    """
+    Opens a DB snapshot read only, None when it can not be compared
+    """
+    if not os.path.isfile(dbfile):
+        print('%s is not a DB snapshot file' % dbfile)
+        return None
+    try:
+        uri = pathlib.Path(dbfile).resolve().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True)
+        version = filechanges.schemaversion(conn)
+        if version < 5:
+            print('%s has no directory rollups (schema version %d), run a '
+                  'scan on it first' % (dbfile, version))
+            conn.close()
+            return None
+        return conn
+    except Error as e:
+        print('Opening %s went wrong: %s' % (dbfile, e))
+    return None
+
+
+def diffdirs(left, right, lpath, rpath, rel=''):
+    """
+    Yields a (change, relative path) per difference below two directories
+    lpath and rpath end with a path separator. Subdirectories on both sides
+    are only descended into when their rollups differ.
+    """
+    lfiles = filechanges.folderfiles(left, lpath)
+    rfiles = filechanges.folderfiles(right, rpath)
+    for name in sorted(lfiles.keys() | rfiles.keys()):
+        if name not in rfiles:
+            yield 'ONLY_LEFT', rel + name
+        elif name not in lfiles:
+            yield 'ONLY_RIGHT', rel + name
+        elif lfiles[name] != rfiles[name]:
+            yield 'CHANGED', rel + name
+    ldirs = dict(filechanges.childdirs(left, lpath))
+    rdirs = dict(filechanges.childdirs(right, rpath))
+    for name in sorted(ldirs.keys() | rdirs.keys()):
+        subrel = os.path.join(rel + name, '')
+        if name not in rdirs:
+            yield 'ONLY_LEFT', subrel
+        elif name not in ldirs:
+            yield 'ONLY_RIGHT', subrel
+        elif (filechanges.dirrollup(left, ldirs[name]) !=
+              filechanges.dirrollup(right, rdirs[name])):
+            yield from diffdirs(left, right, ldirs[name], rdirs[name], subrel)
+
+
+def snapdiff(left, right, lpath, rpath):
+    """
+    Prints the differences between a directory of two DB snapshots and
+    returns whether there is any
+    """
+    lpath, rpath = os.path.join(lpath, ''), os.path.join(rpath, '')
+    if filechanges.dirrollup(left, lpath) == filechanges.dirrollup(right, rpath):
+        return False
+    for change, rel in diffdirs(left, right, lpath, rpath):
+        print(change, rel)
+    return True
+
+
+def main(args):
+    files = [arg for arg in args if not arg.startswith('--')]
+    path = filechanges.getarg(args, '--path')
+    if len(files) != 2 or not path:
+        print(__doc__)
+        return 2
+    left, right = opensnapshot(files[0]), opensnapshot(files[1])
+    try:
+        if left is None or right is None:
+            return 2
+        return int(snapdiff(left, right, path,
+                            filechanges.getarg(args, '--other-path', path)))
+    except Error as e:
+        print('Comparing the snapshots went wrong:', e)
+        return 2
+    finally:
+        for conn in (left, right):
+            if conn is not None:
+                conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
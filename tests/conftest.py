@@ -0,0 +1,70 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import filechanges
+
+
+class ListReport:
+    """
+    Report that keeps the (change, path, detail) of every changed file
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def addrow(self, fn, ffn, fld, d, t, change, detail=''):
+        self.rows.append((change, ffn, detail))
+
+    def rotate(self):
+        return None
+
+    def flush(self):
+        return None
+
+    def rollback(self):
+        return None
+
+    def close(self):
+        return None
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Working directory of a scan, with an empty tree to track below it
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'tree').mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def writeini(workdir):
+    """
+    Writes the lines of filechanges.ini
+    """
+    def write(*lines):
+        (workdir / 'filechanges.ini').write_text(''.join(line + '\n'
+                                                         for line in lines))
+    return write
+
+
+@pytest.fixture
+def scan(workdir):
+    """
+    Runs a scan pass on a fresh connection and returns the changes it
+    reported
+    """
+    def run(settings=None, report=None):
+        report = report or ListReport()
+        conn = filechanges.connectdb()
+        try:
+            filechanges.runfilechanges(conn, report, settings)
+        finally:
+            conn.close()
+        return report.rows
+    return run
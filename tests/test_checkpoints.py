@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+import filechanges
+
+
+def sqlitereport(conn):
+    """
+    Get the report execute() makes for --report=sqlite
+    """
+    return filechanges.HistoryLog(
+        filechanges.RotatingReport(filechanges.makesink('sqlite', conn)), conn)
+
+
+def runpass(settings):
+    """
+    Runs a scan pass reported to the sqlite report, closing the report
+    even when the pass is interrupted, as execute() does
+    """
+    conn = filechanges.connectdb()
+    report = sqlitereport(conn)
+    try:
+        filechanges.runfilechanges(conn, report, settings)
+    finally:
+        report.close()
+        conn.close()
+
+
+def tablerows(query):
+    conn = filechanges.connectdb()
+    try:
+        return sorted(conn.execute(query).fetchall())
+    finally:
+        conn.close()
+
+
+def test_resumed_pass_reports_changes_once(workdir, writeini, monkeypatch):
+    first, second = workdir / 'tree' / 'a', workdir / 'tree' / 'b'
+    for folder in (first, second):
+        folder.mkdir()
+        (folder / 'f.txt').write_text(folder.name)
+    writeini(str(first), str(second))
+
+    endcheckpoint = filechanges.endcheckpoint
+
+    def interrupt(conn, folder, batch, report, settings):
+        if folder == str(second):
+            raise KeyboardInterrupt
+        endcheckpoint(conn, folder, batch, report, settings)
+    monkeypatch.setattr(filechanges, 'endcheckpoint', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        runpass(filechanges.ScanSettings(checkpoint=60))
+    monkeypatch.setattr(filechanges, 'endcheckpoint', endcheckpoint)
+    assert tablerows("SELECT fullname FROM changes") == [
+        (os.path.join(str(first), 'f.txt'),)]
+
+    runpass(filechanges.ScanSettings(checkpoint=60, resume=True))
+    expected = [(os.path.join(str(folder), 'f.txt'), 'IS_SETUP')
+                for folder in (first, second)]
+    assert tablerows("SELECT fullname, change FROM changes") == expected
+    assert tablerows("SELECT d.path || h.name, h.change FROM history h "
+                     "JOIN folders d ON d.id = h.folder") == expected
+    assert tablerows("SELECT * FROM checkpoints") == []
+
+
+class InterruptedReport:
+    """
+    Report that stops the scan as Ctrl-C would on its nth row
+    """
+
+    def __init__(self, report, nth):
+        self.report = report
+        self.nth = nth
+
+    def addrow(self, *values):
+        self.nth -= 1
+        if not self.nth:
+            raise KeyboardInterrupt
+        return self.report.addrow(*values)
+
+    def __getattr__(self, name):
+        return getattr(self.report, name)
+
+
+def test_rotated_sqlite_report_is_rolled_back(workdir, writeini):
+    tree = workdir / 'tree'
+    for i in range(5):
+        (tree / ('f%d.txt' % i)).write_text(str(i))
+    writeini(str(tree))
+    conn = filechanges.connectdb()
+    report = filechanges.HistoryLog(filechanges.RotatingReport(
+        filechanges.makesink('sqlite', conn), 2), conn)
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            filechanges.runfilechanges(conn, InterruptedReport(report, 4))
+    finally:
+        report.close()
+        conn.close()
+    for table in ('changes', 'files', 'history'):
+        assert tablerows("SELECT count(*) FROM " + table) == [(0,)]
+
+    runpass(filechanges.ScanSettings())
+    assert tablerows("SELECT count(*), count(DISTINCT fullname) FROM "
+                     "changes") == [(5, 5)]
@@ -0,0 +1,19 @@
+import os
+
+import filechanges
+
+
+def test_loadflds_skips_blank_lines(workdir, writeini):
+    tree = str(workdir / 'tree')
+    writeini('', '   ', '  ' + tree + '  |.tmp, .bak|hash=sha1', '\t')
+    flds, ext, opts = filechanges.loadflds()
+    assert flds == [tree]
+    assert ext == [['.bak', '.tmp']]
+    assert opts == [{'hash': 'sha1'}]
+
+
+def test_blank_line_does_not_scan_working_directory(workdir, writeini, scan):
+    tree = str(workdir / 'tree')
+    (workdir / 'tree' / 'a.txt').write_text('a')
+    writeini(tree, '')
+    assert scan() == [('IS_SETUP', os.path.join(tree, 'a.txt'), '')]
@@ -0,0 +1,112 @@
+import os
+
+import filechanges
+
+
+def storeddigest(fname):
+    """
+    Get the (digest, algo) the DB keeps for a file
+    """
+    conn = filechanges.connectdb()
+    try:
+        filerow = filechanges.fileindb(conn, fname)
+        return filerow[0], filechanges.rowalgo(filerow)
+    finally:
+        conn.close()
+
+
+def test_blocks_on_sampled_folder_rehash_unchanged_files(workdir, writeini,
+                                                         scan):
+    tree = str(workdir / 'tree')
+    big = os.path.join(tree, 'big.bin')
+    with open(big, 'wb') as open_file:
+        open_file.write(os.urandom(200 * 1024))
+    writeini(tree + '||sample=64K')
+    assert scan() == [('IS_SETUP', big, '')]
+    assert storeddigest(big) == (filechanges.hashdigests(big, 'md5')[0],
+                                 'md5')
+
+    # The sample still matches, but the digest is now a Merkle root
+    writeini(tree + '||sample=64K|blocks=64K')
+    assert scan() == []
+    blocks = filechanges.hashblocks(big, 'md5/65536')[0]
+    assert storeddigest(big) == (filechanges.merkleroot(blocks, 'md5/65536'),
+                                 'md5/65536')
+
+    moved = os.path.join(tree, 'moved.bin')
+    os.rename(big, moved)
+    assert scan() == [('RENAMED', moved, big)]
+
+
+def test_blocks_report_changed_ranges(workdir, writeini, scan):
+    tree = str(workdir / 'tree')
+    fname = os.path.join(tree, 'data.bin')
+    with open(fname, 'wb') as open_file:
+        open_file.write(os.urandom(16 * 1024))
+    writeini(tree + '||blocks=4K|appends=yes')
+    scan()
+
+    with open(fname, 'r+b') as open_file:
+        open_file.seek(5000)
+        open_file.write(b'x' * 10)
+    assert scan() == [('CHANGED', fname, '4096-8192')]
+
+    with open(fname, 'ab') as open_file:
+        open_file.write(b'y' * 100)
+    assert scan() == [('APPENDED', fname, '16384-16484')]
+    blocks = filechanges.hashblocks(fname, 'md5/4096')[0]
+    assert len(blocks) == 5
+    assert storeddigest(fname) == (filechanges.merkleroot(blocks, 'md5/4096'),
+                                   'md5/4096')
+
+
+def test_merkleroot_of_a_single_block_is_the_file_digest(tmp_path):
+    fname = str(tmp_path / 'small.bin')
+    with open(fname, 'wb') as open_file:
+        open_file.write(b'small')
+    assert (filechanges.hashdigests(fname, 'md5/4096') ==
+            filechanges.hashdigests(fname, 'md5'))
+
+
+def rewrite(fname, offset, data):
+    with open(fname, 'r+b') as open_file:
+        open_file.seek(offset)
+        open_file.write(data)
+
+
+def test_appends_check_block_before_a_block_boundary(workdir, writeini, scan):
+    tree = str(workdir / 'tree')
+    fname = os.path.join(tree, 'data.bin')
+    with open(fname, 'wb') as open_file:
+        open_file.write(os.urandom(8 * 1024))
+    writeini(tree + '||blocks=4K|appends=yes')
+    scan()
+
+    # Rewritten in the last block of the previous content, then grown
+    rewrite(fname, 4196, b'xxxx')
+    with open(fname, 'ab') as open_file:
+        open_file.write(b'yyyy')
+    assert scan() == [('CHANGED', fname, '4096-8196')]
+    assert storeddigest(fname) == (filechanges.hashdigests(fname,
+                                                           'md5/4096')[0],
+                                   'md5/4096')
+
+
+def test_paranoid_pass_catches_changes_before_appends(workdir, writeini, scan):
+    tree = str(workdir / 'tree')
+    fname = os.path.join(tree, 'data.bin')
+    with open(fname, 'wb') as open_file:
+        open_file.write(os.urandom(8 * 1024))
+    writeini(tree + '||blocks=4K|appends=yes')
+    scan()
+
+    # The blocks before the end of the previous content are trusted
+    rewrite(fname, 100, b'xxxx')
+    with open(fname, 'ab') as open_file:
+        open_file.write(b'yyyy')
+    assert scan() == [('APPENDED', fname, '8192-8196')]
+    assert scan(filechanges.ScanSettings(rehash=True)) == [
+        ('CHANGED', fname, '0-4096')]
+    assert storeddigest(fname) == (filechanges.hashdigests(fname,
+                                                           'md5/4096')[0],
+                                   'md5/4096')
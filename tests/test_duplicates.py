@@ -0,0 +1,49 @@
+import os
+
+import filechanges
+
+
+def duplicates(minsize=1):
+    conn = filechanges.connectdb()
+    try:
+        counts = {'prefixes': 0, 'hashed': 0, 'bytes': 0}
+        groups = sorted(filechanges.duplicategroups(conn, None, minsize,
+                                                    counts))
+        return groups, counts
+    finally:
+        conn.close()
+
+
+def test_duplicates_reuse_digests_of_unchanged_files(workdir, writeini, scan):
+    tree = str(workdir / 'tree')
+    data = os.urandom(100 * 1024)
+    paths = {name: os.path.join(tree, name)
+             for name in ('a', 'b', 'c', 'other', 'link', 'small1', 'small2')}
+    for name in ('a', 'b', 'c'):
+        with open(paths[name], 'wb') as open_file:
+            open_file.write(data)
+    with open(paths['other'], 'wb') as open_file:
+        open_file.write(os.urandom(len(data)))
+    os.link(paths['a'], paths['link'])
+    for name in ('small1', 'small2'):
+        with open(paths[name], 'w') as open_file:
+            open_file.write('same')
+    writeini(tree)
+    scan()
+
+    groups, counts = duplicates()
+    assert groups == [
+        (4, [[paths['small1']], [paths['small2']]]),
+        (len(data), [sorted([paths['a'], paths['link']]), [paths['b']],
+                     [paths['c']]]),
+    ]
+    assert counts == {'prefixes': 0, 'hashed': 0, 'bytes': 0}
+
+    # A file changed since the scan is hashed, after its prefix
+    with open(paths['c'], 'r+b') as open_file:
+        open_file.seek(len(data) - 1)
+        open_file.write(b'\0' if data[-1] else b'\1')
+    groups, counts = duplicates(minsize=1024)
+    assert groups == [(len(data), [sorted([paths['a'], paths['link']]),
+                                   [paths['b']]])]
+    assert counts['hashed'] == 1
@@ -0,0 +1,31 @@
+import filechanges
+
+
+def sleeps(monkeypatch):
+    """
+    Get the list the seconds execute() sleeps for are added to; the first
+    sleep stops it as Ctrl-C would
+    """
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        raise KeyboardInterrupt
+    monkeypatch.setattr(filechanges.time, 'sleep', sleep)
+    return slept
+
+
+def test_loop_waits_between_passes_by_default(workdir, writeini, monkeypatch):
+    writeini(str(workdir / 'tree'))
+    slept = sleeps(monkeypatch)
+    filechanges.execute(['filechanges.py', '--loop', '--report=csv',
+                         '--quiet'])
+    assert slept == [filechanges.WATCHINTERVAL]
+
+
+def test_loop_interval(workdir, writeini, monkeypatch):
+    writeini(str(workdir / 'tree'))
+    slept = sleeps(monkeypatch)
+    filechanges.execute(['filechanges.py', '--loop', '--interval=2.5',
+                         '--report=csv', '--quiet'])
+    assert slept == [2.5]
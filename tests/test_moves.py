@@ -0,0 +1,59 @@
+import os
+
+import filechanges
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as open_file:
+        open_file.write(text)
+
+
+def test_unchanged_tree_reports_nothing(workdir, writeini, scan):
+    tree = str(workdir / 'tree')
+    # Names around the path separator in sort order
+    for name in ('a.txt', 'a/x', 'a-b', 'a/b/y', 'a0', 'b'):
+        write(os.path.join(tree, name), name)
+    writeini(tree)
+    assert len(scan()) == 6
+    assert scan() == []
+
+
+def test_rename_and_move_are_paired(workdir, writeini, scan):
+    tree = str(workdir / 'tree')
+    old, moved = os.path.join(tree, 'old.txt'), os.path.join(tree, 'sub',
+                                                              'new.txt')
+    write(old, 'content')
+    write(os.path.join(tree, 'gone.txt'), 'other')
+    writeini(tree)
+    scan()
+    os.makedirs(os.path.dirname(moved))
+    os.rename(old, moved)
+    os.remove(os.path.join(tree, 'gone.txt'))
+    assert sorted(scan()) == [('DELETED', os.path.join(tree, 'gone.txt'), ''),
+                              ('RENAMED', moved, old)]
+    assert scan() == []
+
+
+def test_each_gone_file_is_paired_once(workdir, writeini, scan):
+    tree = str(workdir / 'tree')
+    first, second = os.path.join(tree, 'a'), os.path.join(tree, 'b')
+    write(first, 'same')
+    write(second, 'same')
+    writeini(tree)
+    scan()
+    os.remove(first)
+    os.rename(second, os.path.join(tree, 'c'))
+    assert sorted(scan()) == [('DELETED', second, ''),
+                              ('RENAMED', os.path.join(tree, 'c'), first)]
+
+
+def test_empty_files_are_never_paired(workdir, writeini, scan):
+    tree = str(workdir / 'tree')
+    write(os.path.join(tree, 'empty'), '')
+    writeini(tree)
+    scan()
+    os.rename(os.path.join(tree, 'empty'), os.path.join(tree, 'other'))
+    assert sorted(scan()) == [
+        ('DELETED', os.path.join(tree, 'empty'), ''),
+        ('IS_SETUP', os.path.join(tree, 'other'), '')]
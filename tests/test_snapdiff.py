@@ -0,0 +1,27 @@
+import os
+import shutil
+
+import snapdiff
+
+
+def test_snapshot_paths_are_quoted(workdir, writeini, scan):
+    tree = workdir / 'tree'
+    (tree / 'a.txt').write_text('a')
+    writeini(str(tree))
+    scan()
+    left = str(workdir / 'snap#1?.db')
+    shutil.copy('filechanges.db', left)
+    (tree / 'a.txt').write_text('b')
+    scan()
+    args = ['--path=' + str(tree)]
+    assert snapdiff.main([left, left] + args) == 0
+    assert snapdiff.main([left, 'filechanges.db'] + args) == 1
+    # Not cut at the # into an empty DB named snap
+    assert [name for name in os.listdir(workdir)
+            if name.startswith('snap') and not name.startswith('snap#1?')] == []
+
+
+def test_missing_snapshot_is_not_created(workdir, capsys):
+    assert snapdiff.main(['missing.db', 'missing.db', '--path=/']) == 2
+    assert not os.path.exists('missing.db')
+    assert 'missing.db is not a DB snapshot file' in capsys.readouterr().out
@@ -0,0 +1,43 @@
+import os
+import sys
+import statistics
+import subprocess
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+
+import bench_startup
+
+# Largest median import time of filechanges, in milliseconds
+BUDGET_MS = 25
+
+
+def test_import_time_is_within_budget():
+    env = bench_startup.pythonenv()
+    # The run that writes the bytecode cache is not measured
+    bench_startup.importtime(env)
+    imports = [bench_startup.importtime(env) / 1000 for _ in range(7)]
+    assert statistics.median(imports) <= BUDGET_MS
+
+
+def test_lazy_modules_are_not_imported_at_load():
+    env = bench_startup.pythonenv()
+    loaded = (bench_startup.loaded(env, 'import filechanges') -
+              bench_startup.loaded(env, 'pass'))
+    assert sorted(set(bench_startup.LAZY) & loaded) == []
+
+
+def test_run_without_changes_does_not_load_openpyxl(workdir, writeini):
+    pytest.importorskip('openpyxl')
+    (workdir / 'tree' / 'a.txt').write_text('a')
+    writeini(str(workdir / 'tree'))
+    run = ('import sys, filechanges; filechanges.execute(["filechanges.py", '
+           '"--quiet"]); print("openpyxl" in sys.modules)')
+    env = bench_startup.pythonenv()
+    runs = [subprocess.check_output([sys.executable, '-c', run], env=env,
+                                    text=True).split()[-1] for _ in range(2)]
+    assert runs == ['True', 'False']
+    # Both runs still leave a report, the second one with its header only
+    assert len(list(workdir.glob('REPORT_*.xlsx'))) == 2
@@ -3,6 +3,7 @@ import os
 import sys
 import sqlite3
 import hashlib
+import csv
 from sqlite3 import Error
 
 
@@ -288,28 +289,27 @@ def loadflds():
 def checkfilechanges(folder, exclude, ws=None):
     changed = False
     """Checks for files changes"""
-    for subdir, dirs, files in os.walk(folder, topdown=True):
-        for fname in files:
-            origin = os.path.normpath(os.path.join(subdir, fname))
-            if os.path.isfile(origin):
-                # Get file extension and check if it is not excluded
-                fileext = getfileext(origin)
-                if fileext not in exclude:
-                    print('===>', origin)
-                    # Get the file’s md5 hash
-                    filemd5 = md5short(origin)
-                    print('File’s md5 hash is:', filemd5, md5indb(origin))
-                    # If the file has changed, add it to the Excel report
-                    file_changed = haschanged(origin, filemd5)
-                    if file_changed != 'NOT_CHANGED':
-                        changed = True
-                        with open('REPORT_FILE.csv', "a") as file_object:
-                            # Append 'hello modification' at the end of file
-                            file_object.write(
-                                file_changed+", " +
-                                str(getmoddate(origin)) + ', ' + origin + "\n"
-                            )
-                    print('file has changed', haschanged(origin, filemd5))
+    # The report is opened once per folder and written through its buffer
+    with open('REPORT_FILE.csv', "a", newline='') as file_object:
+        report = csv.writer(file_object)
+        for subdir, dirs, files in os.walk(folder, topdown=True):
+            for fname in files:
+                origin = os.path.normpath(os.path.join(subdir, fname))
+                if os.path.isfile(origin):
+                    # Get file extension and check if it is not excluded
+                    fileext = getfileext(origin)
+                    if fileext not in exclude:
+                        print('===>', origin)
+                        # Get the file’s md5 hash
+                        filemd5 = md5short(origin)
+                        print('File’s md5 hash is:', filemd5, md5indb(origin))
+                        # If the file has changed, add it to the report
+                        file_changed = haschanged(origin, filemd5)
+                        if file_changed != 'NOT_CHANGED':
+                            changed = True
+                            report.writerow(
+                                (file_changed, getmoddate(origin), origin))
+                        print('file has changed', haschanged(origin, filemd5))
     return changed
 
 